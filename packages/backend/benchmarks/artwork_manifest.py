@@ -0,0 +1,116 @@
+"""Compare /artworks throughput of the pre-encoded manifest against serializing the listing per request.
+
+The listing is synthetic and served through the ASGI app in-process, so only encoding and the framework are measured.
+Also shows the cost of building the manifest and of appending a single row to it. Run from `packages/backend` with the
+backend's environment, e.g.
+
+    uv run --env-file .env python -m benchmarks.artwork_manifest
+"""
+
+import argparse
+import asyncio
+import math
+import secrets
+import time
+
+import brotli
+import httpx
+from fastapi import FastAPI
+from server import ArtworksResponse, app, listing
+
+SIZES = [10_000, 100_000, 1_000_000]
+# Requests keep being sent until both of these are reached
+MIN_DURATION = 1.0
+MIN_REQUESTS = 3
+
+
+def make_rows(count: int, start: int = 1) -> list[tuple[int, str, str, list[int]]]:
+    return [
+        (row_id, f"user{row_id % 5000}", f"2025-08-01T00-00-00_{secrets.token_hex(8)}.webp ", [128, 512])
+        for row_id in range(start, start + count)
+    ]
+
+
+def build_per_request_app(rows: list[tuple[int, str, str, list[int]]]) -> FastAPI:
+    """The listing as it used to be served, validated and serialized by FastAPI on every request."""
+    per_request_app = FastAPI()
+    works = [(username, filename, variants) for _, username, filename, variants in rows]
+
+    @per_request_app.get("/artworks")
+    async def artworks() -> ArtworksResponse:
+        return ArtworksResponse(artworks=works, cursor=rows[-1][0], has_more=False, total=len(rows))
+
+    return per_request_app
+
+
+async def measure(target: FastAPI, accept_encoding: str) -> tuple[float, int]:
+    transport = httpx.ASGITransport(app=target)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        headers = {"Accept-Encoding": accept_encoding}
+        requests = 0
+        size = 0
+        start = time.perf_counter()
+        while requests < MIN_REQUESTS or time.perf_counter() - start < MIN_DURATION:
+            # Raw, so the client doesn't spend the time decompressing
+            async with client.stream("GET", "/artworks", headers=headers) as response:
+                size = sum([len(chunk) async for chunk in response.aiter_raw()])
+            requests += 1
+
+        return requests / (time.perf_counter() - start), size
+
+
+async def run_benchmark(sizes: list[int]) -> None:
+    for size in sizes:
+        rows = make_rows(size)
+
+        start = time.perf_counter()
+        encoder = listing.ManifestEncoder()
+        encoder.append(rows)
+        encoder.encode()
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoder.append(make_rows(1, start=size + 1))
+        body, gzip_body = encoder.encode()
+        append_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        brotli_body = brotli.compress(body, quality=listing.BROTLI_QUALITY)
+        brotli_time = time.perf_counter() - start
+
+        # Serve the prepared snapshot without going to Postgres
+        listing._snapshot = listing.Snapshot(  # noqa: SLF001
+            encoder=encoder,
+            total=len(encoder.rows),
+            version=(size + 1, size + 1),
+            body=body,
+            gzip_body=gzip_body,
+            brotli_body=brotli_body,
+        )
+        listing._checked_at = math.inf  # noqa: SLF001
+
+        print(
+            f"{size:>9,} rows: build {build_time * 1000:.0f} ms, append one row {append_time * 1000:.1f} ms, "
+            f"brotli {brotli_time * 1000:.0f} ms"
+        )
+        print(f"  {'variant':<28} {'req/s':>9} {'bytes':>12}")
+        for name, target, accept_encoding in (
+            ("per-request serialization", build_per_request_app(rows), "identity"),
+            ("pre-encoded identity", app, "identity"),
+            ("pre-encoded gzip", app, "gzip"),
+            ("pre-encoded br", app, "br, gzip"),
+        ):
+            throughput, response_size = await measure(target, accept_encoding)
+            print(f"  {name:<28} {throughput:>9.1f} {response_size:>12,}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compare peak memory and wall time of the GitHub commit engines for 1-20 MB artworks.
+
+GitHub is replaced with an in-process transport that drains the request bodies without keeping them, so only the
+backend's own overhead is measured. Every engine and size runs in a fresh process, peak RSS is monotonic.
+Run from `packages/backend` with the backend's environment, e.g.
+
+    uv run --env-file .env python -m benchmarks.commit_engines
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import httpx
+from server import gh
+
+SIZES_MB = [1, 5, 10, 20]
+
+
+class DrainingTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async for _ in request.stream:  # type: ignore[union-attr]
+            pass
+
+        path = request.url.path
+        if path.endswith("/contents/artwork.webp"):
+            return httpx.Response(200, json={"commit": {"sha": "c" * 40}})
+        if "/git/commits/" in path:
+            return httpx.Response(200, json={"tree": {"sha": "t" * 40}})
+        return httpx.Response(201, json={"sha": "s" * 40})
+
+
+async def commit(engine: str, file_content: bytes) -> None:
+    await gh.COMMIT_ENGINES[engine](
+        {"Authorization": "token benchmark"},
+        fork_owner="benchmark",
+        fork_name="HHH",
+        new_branch="benchmark",
+        files={"artwork.webp": file_content},
+        message="Add artwork.webp",
+    )
+
+
+async def run_child(engine: str, size_mb: int) -> dict[str, float]:
+    gh._client = httpx.AsyncClient(base_url="https://api.github.com", transport=DrainingTransport())  # noqa: SLF001
+    file_content = os.urandom(size_mb * 1024 * 1024)
+    await commit(engine, b"warm up")
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    await commit(engine, file_content)
+    wall_time = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    await commit(engine, file_content)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall_ms": wall_time * 1000,
+        "peak_rss_growth_mb": (rss_after - rss_before) / 1024,
+        "traced_peak_mb": traced_peak / 1024 / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child", nargs=2, metavar=("ENGINE", "SIZE_MB"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        engine, size_mb = args.child
+        print(json.dumps(asyncio.run(run_child(engine, int(size_mb)))))
+        return
+
+    print(f"{'engine':<10} {'size':>6} {'wall':>10} {'peak RSS growth':>16} {'traced peak':>12}")
+    for size_mb in SIZES_MB:
+        for engine in gh.COMMIT_ENGINES:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.commit_engines", "--child", engine, str(size_mb)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output)
+            print(
+                f"{engine:<10} {size_mb:>4} MB {result['wall_ms']:>7.1f} ms "
+                f"{result['peak_rss_growth_mb']:>13.1f} MB {result['traced_peak_mb']:>9.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
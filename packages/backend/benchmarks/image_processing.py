@@ -0,0 +1,138 @@
+"""Measure the image stage over a corpus of editor exports, per image and through the process pool.
+
+Without `--corpus`, drawings like the editor's are generated at the canvas sizes of common screen heights (the canvas
+is 2 * 95% of the window height tall, with an A4 aspect ratio) and exported the way the editor does, WebP at 70%.
+Also shows how long the event loop stalls when an image is processed inline instead of in the pool. Run from
+`packages/backend` with the backend's environment, e.g.
+
+    uv run --env-file .env python -m benchmarks.image_processing --corpus ~/exports
+"""
+
+import argparse
+import asyncio
+import io
+import random
+import statistics
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+from server import env, images
+
+SCREEN_HEIGHTS = [720, 1080, 1440, 2160]
+STROKES = 400
+
+
+def make_export(screen_height: int, seed: int) -> bytes:
+    height = int(screen_height * 0.95) * 2
+    width = int(height * 2**0.5)
+    rng = random.Random(seed)
+
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for _ in range(STROKES):
+        points = [(rng.randrange(width), rng.randrange(height)) for _ in range(rng.randrange(2, 8))]
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)
+        draw.line(points, fill=color, width=rng.randrange(2, 40), joint="curve")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=70)
+    return buffer.getvalue()
+
+
+def load_corpus(corpus: Path | None, per_size: int) -> list[tuple[str, bytes]]:
+    if corpus is not None:
+        return [(path.name, path.read_bytes()) for path in sorted(corpus.iterdir()) if path.is_file()]
+
+    return [
+        (f"{screen_height}p-{seed}", make_export(screen_height, seed))
+        for screen_height in SCREEN_HEIGHTS
+        for seed in range(per_size)
+    ]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(q * 100) - 1]
+
+
+def run_per_image(corpus: list[tuple[str, bytes]]) -> None:
+    print(f"{'image':<16} {'size':>11} {'output':>11} {'bytes in':>10} {'bytes out':>10} {'q':>3} {'ms':>7}")
+    times = []
+    for name, data in corpus:
+        start = time.perf_counter()
+        try:
+            result = images.process_image(data, env.IMAGE_MAX_PIXELS, env.IMAGE_MAX_DIMENSION, env.IMAGE_MAX_BYTES)
+        except images.InvalidImageError as e:
+            print(f"{name:<16} rejected: {e}")
+            continue
+        elapsed = time.perf_counter() - start
+        times.append(elapsed * 1000)
+
+        print(
+            f"{name:<16} {f'{result.original_width}x{result.original_height}':>11} "
+            f"{f'{result.width}x{result.height}':>11} {len(data):>10,} {len(result.data):>10,} "
+            f"{result.quality:>3} {elapsed * 1000:>7.0f}"
+        )
+
+    if times:
+        print(
+            f"per image: mean {statistics.mean(times):.0f} ms, p50 {percentile(times, 0.5):.0f} ms, "
+            f"p95 {percentile(times, 0.95):.0f} ms, max {max(times):.0f} ms"
+        )
+
+
+async def measure_loop_lag(work: asyncio.Future[object]) -> float:
+    """Longest time a 1 ms ticker on the event loop was held up while `work` ran."""
+    worst = 0.0
+    while not work.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - start - 0.001)
+
+    await work
+    return worst
+
+
+async def run_pool(corpus: list[tuple[str, bytes]]) -> None:
+    await images.start_pool()
+    try:
+        start = time.perf_counter()
+        work = asyncio.gather(*(images.process(data) for _, data in corpus), return_exceptions=True)
+        pool_lag = await measure_loop_lag(work)
+        pool_time = time.perf_counter() - start
+    finally:
+        images.stop_pool()
+
+    _, data = max(corpus, key=lambda item: len(item[1]))
+    loop = asyncio.get_running_loop()
+    inline = loop.create_future()
+    # Scheduled rather than called, so that the ticker is already waiting when it holds up the loop
+    loop.call_soon(
+        lambda: inline.set_result(
+            images.process_image(data, env.IMAGE_MAX_PIXELS, env.IMAGE_MAX_DIMENSION, env.IMAGE_MAX_BYTES)
+        )
+    )
+    inline_lag = await measure_loop_lag(inline)
+
+    print(
+        f"pool of {env.IMAGE_WORKERS}: {len(corpus)} images in {pool_time:.1f} s "
+        f"({len(corpus) / pool_time:.1f} images/s), worst event loop stall {pool_lag * 1000:.1f} ms"
+    )
+    print(f"inline, largest image: worst event loop stall {inline_lag * 1000:.0f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, help="directory of images, generated when not given")
+    parser.add_argument("--per-size", type=int, default=3, help="generated images per screen height")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.per_size)
+    run_per_image(corpus)
+    asyncio.run(run_pool(corpus))
+
+
+if __name__ == "__main__":
+    main()
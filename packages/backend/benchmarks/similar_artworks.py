@@ -0,0 +1,155 @@
+"""Compare near-duplicate lookups in the multi-index of perceptual hashes against a BK-tree and a linear scan.
+
+The hashes are synthetic and clustered the way published artworks are: drawings, each followed by a few slightly
+edited re-publications that are a few bits away from it. Queries are half edits of known drawings and half unrelated
+ones. Also shows how long building each index takes and how much memory it holds. Run from `packages/backend` with
+the backend's environment, e.g.
+
+    uv run --env-file .env python -m benchmarks.similar_artworks --artworks 100000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+from server.similarity import HammingIndex
+
+DISTANCES = [0, 2, 4, 8, 12, 16]
+# Re-publications per drawing, and how many bits each of them flips
+MAX_EDITS = 6
+MAX_EDIT_BITS = 6
+
+
+class BKTree:
+    """Burkhard-Keller tree under the Hamming distance, a child sits on the edge of its distance to its parent."""
+
+    def __init__(self, items: list[tuple[int, Any]]) -> None:
+        self.root: tuple[int, list[Any], dict[int, Any]] | None = None
+        self.nodes = 0
+        self.visited = 0
+        for value, item in items:
+            self.add(value, item)
+
+    def add(self, value: int, item: Any) -> None:
+        if self.root is None:
+            self.root = (value, [item], {})
+            self.nodes += 1
+            return
+
+        node = self.root
+        while True:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (value, [item], {})
+                self.nodes += 1
+                return
+            node = node[2][distance]
+
+    def find(self, value: int, max_distance: int) -> list[tuple[Any, int]]:
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            self.visited += 1
+            distance = (node_value ^ value).bit_count()
+            if distance <= max_distance:
+                results.extend((item, distance) for item in items)
+            # Only these edges can lead to hashes within `max_distance`, by the triangle inequality
+            stack.extend(
+                child for edge, child in children.items() if distance - max_distance <= edge <= distance + max_distance
+            )
+        return results
+
+
+class LinearScan:
+    def __init__(self, items: list[tuple[int, Any]]) -> None:
+        self.items = items
+
+    def find(self, value: int, max_distance: int) -> list[tuple[Any, int]]:
+        return [(item, distance) for h, item in self.items if (distance := (h ^ value).bit_count()) <= max_distance]
+
+
+def flip_bits(rng: random.Random, value: int, bits: int) -> int:
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def make_hashes(count: int, rng: random.Random) -> list[int]:
+    hashes: list[int] = []
+    while len(hashes) < count:
+        drawing = rng.getrandbits(64)
+        hashes.append(drawing)
+        hashes.extend(flip_bits(rng, drawing, rng.randint(1, MAX_EDIT_BITS)) for _ in range(rng.randint(0, MAX_EDITS)))
+    return hashes[:count]
+
+
+def make_queries(hashes: list[int], count: int, rng: random.Random) -> list[int]:
+    edits = [flip_bits(rng, rng.choice(hashes), rng.randint(0, MAX_EDIT_BITS)) for _ in range(count // 2)]
+    return edits + [rng.getrandbits(64) for _ in range(count - len(edits))]
+
+
+def measure_build(build: Callable[[], Any]) -> tuple[Any, float, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, elapsed, size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--artworks", type=int, default=100_000, help="number of hashes in the index")
+    parser.add_argument("--queries", type=int, default=100, help="queries per distance")
+    parser.add_argument("--seed", type=int, default=12)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    hashes = make_hashes(args.artworks, rng)
+    queries = make_queries(hashes, args.queries, rng)
+    items = [(h, i) for i, h in enumerate(hashes)]
+
+    indexes = {}
+    print(f"{len(hashes):,} hashes")
+    for name, build in [
+        ("multi-index", lambda: HammingIndex.build(items)),
+        ("BK-tree", lambda: BKTree(items)),
+        ("linear", lambda: LinearScan(items)),
+    ]:
+        indexes[name], build_time, size = measure_build(build)
+        print(f"  {name:<12} built in {build_time * 1000:>6.0f} ms, {size / 1024 / 1024:>5.1f} MB")
+
+    print(
+        f"{'distance':>8} {'multi-index':>12} {'BK-tree':>10} {'linear':>10} {'speedup':>8} {'checked':>8} "
+        f"{'results':>8}"
+    )
+    multi_index: HammingIndex = indexes["multi-index"]
+    for max_distance in DISTANCES:
+        multi_index.candidates = 0
+        times = {}
+        results = {}
+        for name, index in indexes.items():
+            start = time.perf_counter()
+            results[name] = [sorted(index.find(query, max_distance)) for query in queries]
+            times[name] = (time.perf_counter() - start) / len(queries)
+
+        assert results["multi-index"] == results["BK-tree"] == results["linear"]
+        print(
+            f"{max_distance:>8} {times['multi-index'] * 1000:>9.2f} ms {times['BK-tree'] * 1000:>7.2f} ms "
+            f"{times['linear'] * 1000:>7.2f} ms {times['linear'] / times['multi-index']:>7.1f}x "
+            # Hashes whose full distance the multi-index checked, out of all of them
+            f"{multi_index.candidates / len(queries) / multi_index.hashes:>8.1%} "
+            f"{sum(len(r) for r in results['linear']) / len(queries):>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Compare the per-request overhead of creating a Supabase client against checking one out of the pool.
+
+gotrue is replaced with a local HTTP server answering `GET /auth/v1/user`, so the numbers only contain client
+construction, connection setup and the request itself. Run from `packages/backend` with the backend's environment,
+e.g.
+
+    uv run --env-file .env python -m benchmarks.supabase_clients
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from server import env, sb
+from supabase import AsyncClientOptions, create_async_client
+
+USER = {
+    "id": "00000000-0000-0000-0000-000000000000",
+    "aud": "authenticated",
+    "role": "authenticated",
+    "app_metadata": {},
+    "user_metadata": {},
+    "identities": [],
+    "created_at": "2025-01-01T00:00:00Z",
+}
+
+
+class GoTrueHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:  # noqa: N802
+        body = json.dumps(USER).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+
+async def per_request_client(url: str) -> None:
+    client = await create_async_client(
+        supabase_url=url,
+        supabase_key=env.SUPABASE_KEY,
+        options=AsyncClientOptions(flow_type="pkce"),
+    )
+    await client.auth.get_user("benchmark")
+
+
+async def pooled_client(url: str) -> None:
+    async with sb.internal_client() as client:
+        await client.auth.get_user("benchmark")
+
+
+async def measure(run: Callable[[str], Awaitable[None]], url: str, requests: int, concurrency: int) -> list[float]:
+    durations: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await run(url)
+            durations.append(time.perf_counter() - start)
+
+    await run(url)
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(requests):
+            tg.create_task(timed())
+
+    return durations
+
+
+async def run_benchmark(requests: int, concurrency: int) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GoTrueHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    env.SUPABASE_INTERNAL_URL = url
+    await sb.open_clients()
+    try:
+        print(f"{'client':<12} {'mean':>9} {'p50':>9} {'p95':>9} {'total':>10}")
+        for name, run in (("per-request", per_request_client), ("pooled", pooled_client)):
+            start = time.perf_counter()
+            durations = await measure(run, url, requests, concurrency)
+            total = time.perf_counter() - start
+            durations.sort()
+            mean = statistics.mean(durations)
+            p50 = durations[len(durations) // 2]
+            p95 = durations[int(len(durations) * 0.95)]
+            print(
+                f"{name:<12} {mean * 1000:>6.2f} ms {p50 * 1000:>6.2f} ms {p95 * 1000:>6.2f} ms "
+                f"{total * 1000:>7.1f} ms"
+            )
+    finally:
+        await sb.close_clients()
+        server.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
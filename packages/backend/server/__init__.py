@@ -1,16 +1,75 @@
+import json
+import logging
 import secrets
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
-from typing import Annotated
+from typing import Annotated, Any
+from uuid import UUID
 
-from fastapi import FastAPI, HTTPException, Query, Request, Response, UploadFile
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from gotrue import CodeExchangeParams, SignInWithOAuthCredentials, SignInWithOAuthCredentialsOptions
-from pydantic import BaseModel
-
-from . import env, gh, pg, sb
+from pydantic import BaseModel, Field
+
+from . import (
+    env,
+    feed,
+    forks,
+    gh,
+    images,
+    installations,
+    jobs,
+    listing,
+    migrations,
+    pg,
+    preflight,
+    registry,
+    sb,
+    sessions,
+    similarity,
+    tokens,
+    uploads,
+    verify,
+)
 
-app = FastAPI()
+log = logging.getLogger(__name__)
+log.setLevel(env.LOG_LEVEL)
+log.addHandler(logging.StreamHandler())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    async with AsyncExitStack() as stack:
+        # Torn down in reverse, however far startup got. Each teardown is registered before its startup step, which
+        # might have left something open when it fails, e.g. a pool that couldn't connect
+        stack.push_async_callback(pg.close_pool)
+        await pg.open_pool()
+        stack.push_async_callback(sb.close_clients)
+        await sb.open_clients()
+        stack.push_async_callback(gh.close_client)
+        await gh.open_client()
+        stack.push_async_callback(tokens.stop_refresher)
+        tokens.start_refresher()
+        stack.callback(images.stop_pool)
+        await images.start_pool()
+
+        await migrations.migrate()
+        await installations.load()
+
+        stack.push_async_callback(installations.stop_sync)
+        installations.start_sync()
+        stack.push_async_callback(forks.stop_refresher)
+        forks.start_refresher()
+        stack.push_async_callback(feed.stop_listener)
+        feed.start_listener()
+        stack.push_async_callback(jobs.stop_workers)
+        jobs.start_workers()
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://heavenly-hostas-hosting.github.io"],
@@ -22,19 +81,19 @@ app.add_middleware(
 
 @app.get("/login")
 async def login() -> Response:
-    sb_client = await sb.create_public_client()
-
-    gh_response = await sb_client.auth.sign_in_with_oauth(
-        SignInWithOAuthCredentials(
-            provider="github",
-            options=SignInWithOAuthCredentialsOptions(redirect_to=env.GITHUB_CALLBACK_REDIRECT_URI),
-        ),
-    )
+    async with sb.public_client() as sb_client:
+        gh_response = await sb_client.auth.sign_in_with_oauth(
+            SignInWithOAuthCredentials(
+                provider="github",
+                options=SignInWithOAuthCredentialsOptions(redirect_to=env.GITHUB_CALLBACK_REDIRECT_URI),
+            ),
+        )
+        code_verifier = await sb.get_code_verifier_from_client(sb_client)
 
     response = RedirectResponse(gh_response.url)
     response.set_cookie(
         key=sb.CODE_VERIFIER_COOKIE_KEY,
-        value=await sb.get_code_verifier_from_client(sb_client),
+        value=code_verifier,
         httponly=True,
         secure=True,
         samesite="lax",
@@ -45,8 +104,8 @@ async def login() -> Response:
 
 @app.get("/logout")
 async def logout(request: Request) -> Response:
-    sb_client = await sb.get_session(request)
-    await sb_client.auth.sign_out()
+    async with sb.get_session(request) as sb_client:
+        await sb_client.auth.sign_out()
 
     response = RedirectResponse(env.POST_AUTH_REDIRECT_URI)
     response.delete_cookie(
@@ -70,18 +129,18 @@ async def auth(
     code: Annotated[str, Query()],
     request: Request,
 ) -> RedirectResponse:
-    client = await sb.create_internal_client()
     code_verifier = request.cookies.get(sb.CODE_VERIFIER_COOKIE_KEY)
     if code_verifier is None:
         raise HTTPException(status_code=401, detail="Code verifier not found in cookies")
 
-    gh_response = await client.auth.exchange_code_for_session(
-        CodeExchangeParams(
-            code_verifier=code_verifier,
-            auth_code=code,
-            redirect_to="",
-        ),
-    )
+    async with sb.internal_client() as client:
+        gh_response = await client.auth.exchange_code_for_session(
+            CodeExchangeParams(
+                code_verifier=code_verifier,
+                auth_code=code,
+                redirect_to="",
+            ),
+        )
 
     if gh_response.session is None:
         raise HTTPException(status_code=401, detail="Failed to exchange code for session")
@@ -102,81 +161,129 @@ async def auth(
     return response
 
 
-@app.post("/publish")
-async def publish(  # noqa: C901
-    image: UploadFile,
-    http_request: Request,
-) -> Response:
-    client = await sb.get_session(http_request)
-
-    client_session = await client.auth.get_session()
-    if client_session is None:
-        raise HTTPException(status_code=401, detail="User not authenticated")
-
-    gh_identity = await sb.get_github_identity(client)
-    user_name = gh_identity.identity_data["user_name"]
-    app_token = gh.get_app_token()
-
-    installation_id: int | None = None
-    for installation in await gh.get_app_installations(app_token):
-        if installation["account"]["login"] == user_name:
-            if installation_id is not None:
-                raise HTTPException(status_code=400, detail="Multiple GitHub App installations found for user")
-
-            installation_id = installation["id"]
+class PublishResponse(BaseModel):
+    # `None` when the same artwork is published already, `filename` is then the published one
+    job_id: UUID | None
+    filename: str
+
+
+@app.post(
+    "/publish",
+    status_code=202,
+    response_model=PublishResponse,
+    # The body is streamed by `uploads.ingest`, rather than parsed up front as an `UploadFile`
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"image": {"type": "string", "format": "binary"}},
+                        "required": ["image"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def publish(http_request: Request) -> JSONResponse:
+    uploads.check_content_length(http_request)
+    # Verified locally, the GitHub stages of the pre-flight wait until the upload turns out not to be a duplicate
+    auth_session = await sessions.authenticate(http_request)
+    upload = await uploads.ingest(http_request)
+    try:
+        image = await images.process(upload.source())
+    except images.InvalidImageError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    finally:
+        upload.close()
+
+    duplicate = await jobs.find_duplicate(image.sha256)
+    if duplicate is not None:
+        job_id, file_name = duplicate
+    else:
+        try:
+            await jobs.check_near_duplicate(auth_session.user_name, image.sha256, image.dhash)
+        except jobs.NearDuplicateError as e:
+            # Preflight's 409s are about the installation, this one carries a code the editor tells it apart by
+            raise HTTPException(
+                status_code=409,
+                detail={
+                    "code": "near_duplicate",
+                    "message": f"Too similar to your artwork {e.filename}",
+                    "filename": e.filename,
+                },
+            ) from e
+
+        preflight_result = await preflight.run(auth_session)
+
+        now = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+        random_sequence = secrets.token_hex(8)
+        file_stem = f"{now}_{random_sequence}"
+        file_name = f"{file_stem}.webp"
+
+        job_id, file_name = await jobs.enqueue(
+            username=auth_session.user_name,
+            installation_id=preflight_result.installation_id,
+            fork_name=preflight_result.repository["name"],
+            filename=file_name,
+            image=image.data,
+            content_sha256=image.sha256,
+            dhash=image.dhash,
+        )
 
-    if installation_id is None:
-        raise HTTPException(status_code=404, detail="No GitHub App installation found")
+    response = JSONResponse(
+        content=PublishResponse(job_id=job_id, filename=file_name).model_dump(mode="json"),
+        status_code=202 if job_id is not None else 200,
+    )
+    sb.set_response_token_cookies_(
+        response,
+        access_token=auth_session.access_token,
+        refresh_token=auth_session.refresh_token,
+    )
 
-    app_installation_token = await gh.get_app_installation_token(installation_id, app_token)
-    installation_repositories = await gh.get_app_installation_repositories(app_installation_token)
+    return response
 
-    total_repo_count = installation_repositories["total_count"]
-    if total_repo_count == 0:
-        raise HTTPException(status_code=409, detail="GitHub App not installed on any repository")
-    elif total_repo_count > 1:
-        raise HTTPException(status_code=409, detail="GitHub App must be installed on a single repository")
 
-    root_app_installation_token = await gh.get_app_installation_token(env.GIT_UPSTREAM_APP_INSTALLATION_ID, app_token)
-    all_fork_full_names = set(
-        repo["full_name"] for repo in await gh.get_app_installation_repository_forks(root_app_installation_token)
+class PublishJobResponse(BaseModel):
+    job_id: UUID
+    filename: str
+    status: str
+    stage: str
+    attempts: int
+    error: str | None
+
+
+@app.get("/publish/{job_id}")
+async def publish_job(job_id: UUID) -> PublishJobResponse:
+    job = await pg.publish_jobs_get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Publish job not found")
+
+    return PublishJobResponse(
+        job_id=job.id,
+        filename=job.filename,
+        status=job.status,
+        stage=job.stage,
+        attempts=job.attempts,
+        error=job.error,
     )
-    repository = installation_repositories["repositories"][0]
 
-    if not repository["fork"] or repository["full_name"] not in all_fork_full_names:
-        raise HTTPException(
-            status_code=409, detail="The installation repository must be a fork of the main repository"
-        )
 
-    now = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
-    random_sequence = secrets.token_hex(8)
-    file_stem = f"{now}_{random_sequence}"
-    file_name = f"{file_stem}.webp"
-
-    commit_hash = await gh.commit_and_create_pull_request(
-        root_app_installation_token=root_app_installation_token,
-        app_installation_token=app_installation_token,
-        fork_owner=user_name,
-        fork_name=repository["name"],
-        new_branch=file_stem,
-        file_path=file_name,
-        file_content=await image.read(),
-        pr_title=f"Publish {file_name}",
-    )
-    await pg.github_files_insert_row(
-        username=user_name,
-        filename=file_name,
-        commit_hash=commit_hash,
-    )
+@app.post("/webhooks/github", status_code=204)
+async def github_webhook(
+    request: Request,
+    x_github_event: Annotated[str, Header()],
+    x_hub_signature_256: Annotated[str | None, Header()] = None,
+) -> Response:
+    body = await request.body()
+    if not installations.verify_webhook_signature(body, x_hub_signature_256):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
 
-    response = Response(content="Publish endpoint hit", status_code=200)
-    sb.set_response_token_cookies_(
-        response,
-        access_token=client_session.access_token,
-        refresh_token=client_session.refresh_token,
-    )
+    await installations.handle_webhook_event(x_github_event, json.loads(body))
 
-    return response
+    return Response(status_code=204)
 
 
 class LoginStatusResponse(BaseModel):
@@ -187,12 +294,7 @@ class LoginStatusResponse(BaseModel):
 @app.get("/status", response_model=LoginStatusResponse)
 async def status(http_request: Request) -> JSONResponse:
     try:
-        client = await sb.get_session(http_request)
-        client_session = await client.auth.get_session()
-        if client_session is None:
-            raise HTTPException(status_code=401, detail="User not authenticated")
-
-        gh_identity = await sb.get_github_identity(client)
+        auth_session = await sessions.authenticate(http_request)
     except HTTPException as e:
         if e.status_code != 401:
             raise
@@ -204,17 +306,16 @@ async def status(http_request: Request) -> JSONResponse:
             ).model_dump()
         )
 
-    user_name = gh_identity.identity_data["user_name"]
     response = JSONResponse(
         content=LoginStatusResponse(
-            username=user_name,
+            username=auth_session.user_name,
             logged_in=True,
         ).model_dump()
     )
     sb.set_response_token_cookies_(
         response,
-        access_token=client_session.access_token,
-        refresh_token=client_session.refresh_token,
+        access_token=auth_session.access_token,
+        refresh_token=auth_session.refresh_token,
     )
 
     return response
@@ -229,23 +330,206 @@ async def verify_pr(
     filename: Annotated[str, Query()],
     commit_hash: Annotated[str, Query()],
 ) -> VerifyPRResponse:
-    is_valid = await pg.github_files_check_exists(
-        filename=filename,
-        commit_hash=commit_hash,
-    )
+    [is_valid] = await verify.verify_many([(filename, commit_hash)])
 
     return VerifyPRResponse(is_valid=is_valid)
 
 
+class VerifyPRRequest(BaseModel):
+    filename: str
+    commit_hash: str
+
+
+class VerifyPRBatchRequest(BaseModel):
+    prs: Annotated[list[VerifyPRRequest], Field(max_length=verify.MAX_BATCH_SIZE)]
+
+
+class VerifyPRBatchResponse(BaseModel):
+    # In the order of the requested PRs
+    results: list[VerifyPRResponse]
+
+
+@app.post("/verify_pr/batch")
+async def verify_pr_batch(body: VerifyPRBatchRequest) -> VerifyPRBatchResponse:
+    """Verify up to `MAX_BATCH_SIZE` PRs at once, with a single query for the ones not verified recently."""
+    results = await verify.verify_many([(pr.filename, pr.commit_hash) for pr in body.prs])
+
+    return VerifyPRBatchResponse(results=[VerifyPRResponse(is_valid=is_valid) for is_valid in results])
+
+
 class ArtworksResponse(BaseModel):
-    artworks: list[tuple[str, str]]
+    # Username, filename and the sizes of its smaller variants, see `images.variant_path`
+    artworks: list[tuple[str, str, list[int]]]
+    # Id of the last returned artwork, pass it as `since_id` to only get newer ones
+    cursor: int
+    has_more: bool
+    # Number of slots in the whole listing, not known for `since_id` pages
+    total: int | None = None
+
+
+def _artworks_cache_headers() -> dict[str, str]:
+    return {
+        "Cache-Control": (
+            f"public, max-age={env.ARTWORKS_CACHE_MAX_AGE}, "
+            f"stale-while-revalidate={env.ARTWORKS_STALE_WHILE_REVALIDATE}"
+        ),
+    }
+
+
+@app.get("/artworks", response_model=ArtworksResponse)
+async def artworks(
+    since_id: Annotated[int | None, Query(ge=0)] = None,
+    offset: Annotated[int | None, Query(ge=0)] = None,
+    limit: Annotated[int, Query(ge=1, le=listing.MAX_PAGE_SIZE)] = listing.MAX_PAGE_SIZE,
+    if_none_match: Annotated[str | None, Header()] = None,
+    accept_encoding: Annotated[str | None, Header()] = None,
+) -> Response:
+    """Get all artworks in publishing order.
+
+    With `offset` only the slots from `offset` up to `offset + limit` are returned, with `since_id` only up to `limit`
+    artworks published after it.
+    """
+    headers = _artworks_cache_headers()
+
+    if since_id is not None and offset is not None:
+        raise HTTPException(status_code=400, detail="since_id and offset can't be combined")
+
+    if since_id is not None:
+        rows, has_more = await listing.get_since(since_id, limit)
+        delta = ArtworksResponse(
+            artworks=[(username, filename, variants) for _, username, filename, variants in rows],
+            cursor=rows[-1][0] if rows else since_id,
+            has_more=has_more,
+        )
+        return Response(content=delta.model_dump_json(), media_type="application/json", headers=headers)
+
+    snapshot = await listing.get_snapshot()
+
+    if offset is not None:
+        rows, cursor = listing.get_range(snapshot, offset, limit)
+        page = ArtworksResponse(
+            artworks=[(username, filename, variants) for _, username, filename, variants in rows],
+            cursor=cursor,
+            has_more=offset + limit < snapshot.total,
+            total=snapshot.total,
+        )
+        return Response(content=page.model_dump_json(), media_type="application/json", headers=headers)
 
+    content_encoding = listing.negotiate(snapshot, accept_encoding)
+    etag = listing.get_etag(snapshot, content_encoding)
+    headers["ETag"] = etag
+    headers["Vary"] = "Accept-Encoding"
+
+    if listing.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+
+    body = listing.get_body(snapshot, content_encoding)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/artworks/stream")
+async def artworks_stream(
+    since_id: Annotated[int | None, Query(ge=0)] = None,
+    last_event_id: Annotated[int | None, Header()] = None,
+) -> StreamingResponse:
+    """Stream newly published artworks as Server-Sent Events.
+
+    `since_id` (or `Last-Event-ID` when the browser reconnects) first replays the artworks published after it.
+    """
+    return StreamingResponse(
+        feed.stream(last_event_id if last_event_id is not None else since_id),
+        media_type="text/event-stream",
+        # nginx would otherwise buffer the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+class ArtworkSlotResponse(BaseModel):
+    slot: int
+    username: str
+    filename: str
+    variants: list[int]
+
+
+@app.get("/artworks/{filename}", response_model=ArtworkSlotResponse)
+async def artwork_slot(filename: str) -> JSONResponse:
+    snapshot = await listing.get_snapshot()
+
+    slot = snapshot.get_slot(filename)
+    if slot is None:
+        raise HTTPException(status_code=404, detail="Artwork not found")
+
+    _, username, stored_filename, variants = snapshot.get_row(slot)
+    return JSONResponse(
+        content=ArtworkSlotResponse(
+            slot=slot,
+            username=username,
+            filename=stored_filename,
+            variants=variants,
+        ).model_dump(),
+        headers=_artworks_cache_headers(),
+    )
+
+
+class SimilarArtworkResponse(BaseModel):
+    username: str
+    filename: str
+    # Bits (of 64) in which the perceptual hashes differ
+    distance: int
+
+
+class SimilarArtworksResponse(BaseModel):
+    # Closest first
+    artworks: list[SimilarArtworkResponse]
+
+
+@app.get("/artworks/{filename}/similar", response_model=SimilarArtworksResponse)
+async def similar_artworks(
+    filename: str,
+    distance: Annotated[int, Query(ge=0, le=similarity.MAX_DISTANCE)] = similarity.DEFAULT_DISTANCE,
+) -> JSONResponse:
+    """Get up to `MAX_RESULTS` artworks whose perceptual hash is within `distance` bits of this one's."""
+    if not similarity.is_loaded():
+        raise HTTPException(status_code=503, detail="Similarity index is loading")
+
+    dhash = similarity.get_hash(filename)
+    if dhash is None:
+        # Or published before perceptual hashes were, and not backfilled yet
+        raise HTTPException(status_code=404, detail="Artwork not found")
+
+    similar = [
+        SimilarArtworkResponse(username=username, filename=other_filename, distance=other_distance)
+        for username, other_filename, other_distance in similarity.find(dhash, distance)
+        if other_filename != filename.rstrip()
+    ]
+    return JSONResponse(
+        content=SimilarArtworksResponse(artworks=similar[: similarity.MAX_RESULTS]).model_dump(),
+        headers=_artworks_cache_headers(),
+    )
 
-@app.get("/artworks")
-async def artworks() -> ArtworksResponse:
-    works = await pg.github_files_get_all()
 
-    return ArtworksResponse(artworks=works)
+@app.get("/stats")
+async def stats() -> dict[str, Any]:
+    return {
+        "pg": pg.get_pool_stats(),
+        "sb": sb.get_stats(),
+        "sessions": sessions.get_stats(),
+        "gh": gh.get_client_stats(),
+        "tokens": tokens.get_stats(),
+        "installations": installations.get_stats(),
+        "forks": forks.get_stats(),
+        "jobs": jobs.get_stats(),
+        "listing": listing.get_stats(),
+        "feed": feed.get_stats(),
+        "verify": verify.get_stats(),
+        "similarity": similarity.get_stats(),
+        "uploads": uploads.get_stats(),
+        "images": images.get_stats(),
+        "registry": registry.get_stats(),
+    }
 
 
 if __name__ == "__main__":
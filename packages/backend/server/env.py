@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 from . import utils
@@ -20,3 +21,40 @@ GIT_UPSTREAM_REPO = utils.assure_get_env("GIT_UPSTREAM_REPO")
 GIT_UPSTREAM_DATA_BRANCH = utils.assure_get_env("GIT_UPSTREAM_DATA_BRANCH")
 GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH = utils.assure_get_env("GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH")
 GIT_UPSTREAM_APP_INSTALLATION_ID = int(utils.assure_get_env("GIT_UPSTREAM_APP_INSTALLATION_ID"))
+GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+PUBLISH_HMAC_SECRET = os.getenv("PUBLISH_HMAC_SECRET")
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "2"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+POSTGRES_POOL_MAX_IDLE = float(os.getenv("POSTGRES_POOL_MAX_IDLE", "600"))
+
+SUPABASE_CLIENT_POOL_SIZE = int(os.getenv("SUPABASE_CLIENT_POOL_SIZE", "10"))
+
+GITHUB_HTTP_MAX_CONNECTIONS = int(os.getenv("GITHUB_HTTP_MAX_CONNECTIONS", "20"))
+GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+GITHUB_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("GITHUB_HTTP_KEEPALIVE_EXPIRY", "60"))
+GITHUB_HTTP_TIMEOUT = float(os.getenv("GITHUB_HTTP_TIMEOUT", "30"))
+GITHUB_HTTP_CONNECT_TIMEOUT = float(os.getenv("GITHUB_HTTP_CONNECT_TIMEOUT", "10"))
+
+GITHUB_COMMIT_ENGINE = os.getenv("GITHUB_COMMIT_ENGINE", "git-data")
+if GITHUB_COMMIT_ENGINE not in ("contents", "git-data"):
+    msg = f"Unknown GITHUB_COMMIT_ENGINE '{GITHUB_COMMIT_ENGINE}', expected 'contents' or 'git-data'."
+    raise OSError(msg)
+
+ARTWORKS_SNAPSHOT_TTL = float(os.getenv("ARTWORKS_SNAPSHOT_TTL", "5"))
+ARTWORKS_CACHE_MAX_AGE = int(os.getenv("ARTWORKS_CACHE_MAX_AGE", "5"))
+ARTWORKS_STALE_WHILE_REVALIDATE = int(os.getenv("ARTWORKS_STALE_WHILE_REVALIDATE", "30"))
+
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", "2"))
+PUBLISH_JOB_MAX_ATTEMPTS = int(os.getenv("PUBLISH_JOB_MAX_ATTEMPTS", "5"))
+PUBLISH_MAX_UPLOAD_SIZE = int(os.getenv("PUBLISH_MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+PUBLISH_UPLOAD_SPOOL_SIZE = int(os.getenv("PUBLISH_UPLOAD_SPOOL_SIZE", str(1024 * 1024)))
+PUBLISH_NEAR_DUPLICATE_DISTANCE = int(os.getenv("PUBLISH_NEAR_DUPLICATE_DISTANCE", "-1"))
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "40000000"))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(1024 * 1024)))
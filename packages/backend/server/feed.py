@@ -0,0 +1,164 @@
+import asyncio
+import contextlib
+import json
+import logging
+from collections import Counter
+from collections.abc import AsyncIterator
+from typing import Any
+
+from . import listing, pg, registry, similarity, verify
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 15
+RECONNECT_MAX_DELAY = 60
+# Events a subscriber can fall behind by before it is disconnected, it catches up again with `Last-Event-ID`
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Queues of the connected subscribers, `None` tells a subscriber that it fell behind
+_subscribers: set[asyncio.Queue[dict[str, Any] | None]] = set()
+# Id of the newest artwork seen, to catch up on the ones inserted while the listener was reconnecting
+_last_id: int | None = None
+_listener: asyncio.Task[None] | None = None
+_metrics: Counter[str] = Counter()
+
+
+def _dispatch(event: dict[str, Any]) -> None:
+    global _last_id
+
+    _last_id = max(_last_id or 0, event["id"])
+    _metrics["events"] += 1
+    listing.invalidate()
+
+    for queue in list(_subscribers):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            _metrics["subscribers_dropped"] += 1
+            _subscribers.discard(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+async def _catch_up() -> None:
+    global _last_id
+
+    if _last_id is None:
+        _last_id, _ = await pg.github_files_get_version()
+        return
+
+    has_more = True
+    while has_more:
+        rows, has_more = await listing.get_since(_last_id, listing.MAX_PAGE_SIZE)
+        for row_id, username, filename, variants in rows:
+            _dispatch({"id": row_id, "username": username, "filename": filename, "variants": variants})
+
+
+async def _listen() -> None:
+    delay = 1
+    while True:
+        try:
+            async with await pg.open_listen_connection(pg.GITHUB_FILES_CHANNEL) as conn:
+                _metrics["connects"] += 1
+                delay = 1
+                # Listening already, so no artwork recorded from here on is missing from the registry or the
+                # similarity index
+                await registry.load()
+                await similarity.load()
+                await _catch_up()
+
+                async for notify in conn.notifies():
+                    payload = json.loads(notify.payload)
+                    # Replaces a negative verification cached before the row was recorded
+                    registry.add(payload["filename"], payload["commit_hash"])
+                    verify.remember(payload["filename"], payload["commit_hash"])
+                    similarity.add(payload["username"], payload["filename"], payload["dhash"])
+                    _dispatch(
+                        {
+                            "id": payload["id"],
+                            "username": payload["username"],
+                            "filename": payload["filename"],
+                            "variants": payload["variants"],
+                        }
+                    )
+        except Exception:
+            # Deaf to other processes' artworks until reconnected, a miss in the registry can't be trusted meanwhile
+            registry.unload()
+            log.exception("Artwork listener failed, reconnecting in %d s", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+def start_listener() -> None:
+    """Start the single `LISTEN` connection of this process, which fans inserted artworks out to subscribers."""
+    global _listener
+
+    _listener = asyncio.create_task(_listen())
+
+
+async def stop_listener() -> None:
+    global _listener
+
+    if _listener is not None:
+        _listener.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _listener
+        _listener = None
+
+
+def _format_event(event: dict[str, Any]) -> str:
+    data = json.dumps(
+        {"username": event["username"], "filename": event["filename"], "variants": event["variants"]},
+        separators=(",", ":"),
+    )
+    return f"id: {event['id']}\nevent: artwork\ndata: {data}\n\n"
+
+
+async def stream(since_id: int | None) -> AsyncIterator[str]:
+    """Stream inserted artworks as Server-Sent Events, starting after the artwork with id `since_id` if given.
+
+    The subscription starts before catching up on the missed artworks, so none are lost in between. Duplicates are
+    skipped by id, which follows commit order (see `pg.github_files_insert_row`), so no artwork arrives after one
+    with a higher id.
+    """
+    queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+    _subscribers.add(queue)
+    _metrics["subscribed"] += 1
+    try:
+        last_sent_id = since_id if since_id is not None else _last_id or 0
+        yield "retry: 3000\n\n"
+
+        if since_id is not None:
+            has_more = True
+            while has_more:
+                rows, has_more = await listing.get_since(last_sent_id, listing.MAX_PAGE_SIZE)
+                for row_id, username, filename, variants in rows:
+                    yield _format_event(
+                        {"id": row_id, "username": username, "filename": filename, "variants": variants}
+                    )
+                    last_sent_id = row_id
+
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+
+            if event is None:
+                # Fell behind, the client reconnects and catches up with `Last-Event-ID`
+                return
+
+            if event["id"] > last_sent_id:
+                yield _format_event(event)
+                last_sent_id = event["id"]
+    finally:
+        _subscribers.discard(queue)
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "subscribers": len(_subscribers),
+    }
@@ -0,0 +1,115 @@
+import asyncio
+import contextlib
+import logging
+from collections import Counter
+from typing import Any
+
+from . import env, gh, tokens
+
+log = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 10 * 60
+
+UPSTREAM_FULL_NAME = f"{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}".lower()
+
+# Lowercased full names of the upstream repository's forks
+_full_names: set[str] = set()
+# (ETag, lowercased full names, has next page) of every page, in order
+_pages: list[tuple[str | None, list[str], bool]] = []
+_refresh_lock = asyncio.Lock()
+_refresher: asyncio.Task[None] | None = None
+_metrics: Counter[str] = Counter()
+
+
+async def refresh() -> None:
+    """Page through all forks of the upstream repository, re-validating already known pages with their ETags."""
+    async with _refresh_lock:
+        token = await tokens.get_installation_token(env.GIT_UPSTREAM_APP_INSTALLATION_ID)
+
+        pages: list[tuple[str | None, list[str], bool]] = []
+        has_next = True
+        while has_next:
+            page = len(pages) + 1
+            previous = _pages[page - 1] if page <= len(_pages) else None
+
+            forks, etag, has_next = await gh.get_upstream_repository_forks_page(
+                token,
+                page,
+                etag=previous[0] if previous is not None else None,
+            )
+            if forks is None and previous is not None:
+                _metrics["pages_not_modified"] += 1
+                pages.append(previous)
+                # Unchanged, and so is whether a page follows it
+                has_next = previous[2]
+                continue
+
+            _metrics["pages_fetched"] += 1
+            pages.append((etag, [fork["full_name"].lower() for fork in forks or []], bool(has_next)))
+
+        _pages[:] = pages
+        _full_names.clear()
+        _full_names.update(full_name for _, full_names, _ in pages for full_name in full_names)
+
+
+async def _refresh_loop() -> None:
+    while True:
+        try:
+            await refresh()
+        except Exception:
+            log.exception("Failed to refresh the fork registry")
+
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+
+def start_refresher() -> None:
+    global _refresher
+
+    _refresher = asyncio.create_task(_refresh_loop())
+
+
+async def stop_refresher() -> None:
+    global _refresher
+
+    if _refresher is not None:
+        _refresher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _refresher
+        _refresher = None
+
+
+def contains(full_name: str) -> bool:
+    return full_name.lower() in _full_names
+
+
+async def is_upstream_fork(repository: dict[str, Any], app_installation_token: str) -> bool:
+    """Check whether a repository is a direct fork of the upstream repository.
+
+    Known forks are an O(1) registry lookup, otherwise (e.g. a fork created after the last refresh) the repository's
+    own `parent` is checked, fetching the full repository if the given one doesn't include it.
+    """
+    if not repository["fork"]:
+        return False
+
+    if contains(repository["full_name"]):
+        _metrics["registry_hits"] += 1
+        return True
+
+    _metrics["parent_checks"] += 1
+    parent = repository.get("parent")
+    if parent is None:
+        parent = (await gh.get_repository(repository["full_name"], app_installation_token)).get("parent")
+
+    if parent is None or parent["full_name"].lower() != UPSTREAM_FULL_NAME:
+        return False
+
+    _full_names.add(repository["full_name"].lower())
+    return True
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "forks": len(_full_names),
+        "pages": len(_pages),
+    }
@@ -1,140 +1,342 @@
-import base64  # noqa: F401
-import time
+import asyncio
+import base64
+from collections import Counter
+from collections.abc import AsyncIterator
 from typing import Any
 
 import httpx
-import jwt
 
 from . import env
 
+_client: httpx.AsyncClient | None = None
+_metrics: Counter[str] = Counter()
 
-def get_app_token() -> str:
-    """Generate a JWT token for the GitHub App."""
-    now = int(time.time())
-    payload = {
-        "iat": now,
-        "exp": now + (3 * 60),  # JWT valid for 3 minutes
-        "iss": env.CLIENT_ID,  # GitHub App ID
-    }
 
-    return jwt.encode(payload, env.PRIVATE_KEY, algorithm="RS256")
+async def _trace(event_name: str, info: dict[str, Any]) -> None:
+    if event_name == "connection.connect_tcp.complete":
+        _metrics["connections_opened"] += 1
 
 
-async def get_app_installations(app_token: str) -> list[dict[str, Any]]:
-    """Get all installations of the GitHub App."""
-    headers = {
-        "Authorization": f"Bearer {app_token}",
-        "Accept": "application/vnd.github+json",
+async def _on_request(request: httpx.Request) -> None:
+    request.extensions["trace"] = _trace
+    _metrics["requests"] += 1
+
+
+async def _on_response(response: httpx.Response) -> None:
+    http_version = response.http_version.lower().replace("/", "_").replace(".", "_")
+    _metrics[f"responses_{http_version}"] += 1
+
+
+async def open_client() -> None:
+    """Open the shared keep-alive client used for all GitHub API calls."""
+    global _client
+
+    _client = httpx.AsyncClient(
+        base_url="https://api.github.com",
+        headers={"Accept": "application/vnd.github+json"},
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=env.GITHUB_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=env.GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=env.GITHUB_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(env.GITHUB_HTTP_TIMEOUT, connect=env.GITHUB_HTTP_CONNECT_TIMEOUT),
+        event_hooks={"request": [_on_request], "response": [_on_response]},
+    )
+
+
+async def close_client() -> None:
+    global _client
+
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    if _client is None:
+        msg = "GitHub HTTP client is not open."
+        raise RuntimeError(msg)
+    return _client
+
+
+def get_client_stats() -> dict[str, int]:
+    """Get request and connection counters of the shared client, useful to see connection reuse.
+
+    Only what the event hooks and the trace extension report, the pool's own state isn't public.
+    """
+    return {
+        **_metrics,
+        "connections_reused": max(_metrics["requests"] - _metrics["connections_opened"], 0),
     }
-    async with httpx.AsyncClient() as client:
-        r = await client.get("https://api.github.com/app/installations", headers=headers)
+
+
+async def get_app_installations(app_token: str) -> list[dict[str, Any]]:
+    """Get all installations of the GitHub App, following pagination."""
+    headers = {"Authorization": f"Bearer {app_token}"}
+    installations: list[dict[str, Any]] = []
+
+    url: str | None = "/app/installations?per_page=100"
+    while url is not None:
+        r = await get_client().get(url, headers=headers)
         r.raise_for_status()
-        return r.json()
+        installations.extend(r.json())
+        url = r.links.get("next", {}).get("url")
+
+    return installations
+
+
+async def get_user_installation(username: str, app_token: str) -> dict[str, Any] | None:
+    """Get the GitHub App installation of a user, if there is one."""
+    headers = {"Authorization": f"Bearer {app_token}"}
+    r = await get_client().get(f"/users/{username}/installation", headers=headers)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
 
 
 async def get_app_installation_repositories(app_installation_token: str) -> dict[str, Any]:
     """Get all repositories a GitHub App installation has access to."""
-    headers = {
-        "Authorization": f"Bearer {app_installation_token}",
-        "Accept": "application/vnd.github+json",
-    }
-    async with httpx.AsyncClient() as client:
-        r = await client.get("https://api.github.com/installation/repositories", headers=headers)
-        r.raise_for_status()
-        return r.json()
+    headers = {"Authorization": f"Bearer {app_installation_token}"}
+    r = await get_client().get("/installation/repositories", headers=headers)
+    r.raise_for_status()
+    return r.json()
+
+
+async def create_app_installation_token(installation_id: int, app_token: str) -> dict[str, Any]:
+    """Create an installation token for the GitHub App, prefer the cached `tokens.get_installation_token`."""
+    headers = {"Authorization": f"Bearer {app_token}"}
+    r = await get_client().post(f"/app/installations/{installation_id}/access_tokens", headers=headers)
+    r.raise_for_status()
+    return r.json()
+
 
+async def get_repository(full_name: str, app_installation_token: str) -> dict[str, Any]:
+    headers = {"Authorization": f"Bearer {app_installation_token}"}
+    r = await get_client().get(f"/repos/{full_name}", headers=headers)
+    r.raise_for_status()
+    return r.json()
 
-async def get_app_installation_token(installation_id: int, app_token: str) -> str:
-    """Get an installation token for the GitHub App.
 
-    This token is used to perform actions on behalf of the installation.
+async def get_upstream_repository_forks_page(
+    app_installation_token: str,
+    page: int,
+    etag: str | None = None,
+) -> tuple[list[dict[str, Any]] | None, str | None, bool | None]:
+    """Get a page of the upstream repository's forks, oldest first so that earlier pages rarely change.
+
+    Returns the forks (`None` if the page matches `etag`), the page's ETag and whether there is a next page (`None`
+    along with the forks, a 304 doesn't have to repeat the Link header). Conditional requests answered with 304 don't
+    count against the rate limit.
     """
-    headers = {
-        "Authorization": f"Bearer {app_token}",
-        "Accept": "application/vnd.github+json",
-    }
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-            headers=headers,
-        )
-        r.raise_for_status()
-        return r.json()["token"]
+    headers = {"Authorization": f"Bearer {app_installation_token}"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
 
+    r = await get_client().get(
+        f"/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/forks",
+        params={"sort": "oldest", "per_page": 100, "page": page},
+        headers=headers,
+    )
+    if r.status_code == 304:
+        return None, etag, None
 
-async def get_app_installation_repository_forks(app_installation_token: str) -> list[dict[str, Any]]:
-    headers = {
-        "Authorization": f"Bearer {app_installation_token}",
-        "Accept": "application/vnd.github+json",
-    }
-    async with httpx.AsyncClient() as client:
-        r = await client.get(
-            f"https://api.github.com/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/forks",
-            headers=headers,
-        )
-        r.raise_for_status()
-        return r.json()
+    r.raise_for_status()
+    return r.json(), r.headers.get("ETag"), "next" in r.links
 
 
-async def commit_and_create_pull_request(
-    root_app_installation_token: str,
-    app_installation_token: str,
+async def _commit_with_contents_api(
+    headers: dict[str, str],
     fork_owner: str,
     fork_name: str,
     new_branch: str,
-    file_path: str,
-    file_content: bytes,
-    pr_title: str,
+    files: dict[str, bytes],
+    message: str,
 ) -> str:
-    root_auth_headers = {"Authorization": f"token {root_app_installation_token}"}
-    auth_headers = {"Authorization": f"token {app_installation_token}"}
-    meta_headers = {"Accept": "application/vnd.github+json"}
-
-    root_headers = root_auth_headers | meta_headers
-    headers = auth_headers | meta_headers
-
-    async with httpx.AsyncClient() as client:
-        # Get SHA of the data branch to create a new branch off of in the fork
-        # r = await client.get(
-        #     f"https://api.github.com/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/git/refs/heads/{env.GIT_UPSTREAM_DATA_BRANCH}",
-        #     headers=headers,
-        # )
-        # r.raise_for_status()
-        # base_sha = r.json()["object"]["sha"]
-
-        # Create a new branch in the fork
-        r = await client.post(
-            f"https://api.github.com/repos/{fork_owner}/{fork_name}/git/refs",
-            headers=headers,
-            json={"ref": f"refs/heads/{new_branch}", "sha": env.GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH},
-        )
-        r.raise_for_status()
+    if len(files) != 1:
+        # Every PUT of the Contents API is a commit of its own
+        msg = "The Contents API commits a single file."
+        raise ValueError(msg)
+    [(file_path, file_content)] = files.items()
+
+    client = get_client()
+
+    # Get SHA of the data branch to create a new branch off of in the fork
+    # r = await client.get(
+    #     f"/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/git/refs/heads/{env.GIT_UPSTREAM_DATA_BRANCH}",
+    #     headers=headers,
+    # )
+    # r.raise_for_status()
+    # base_sha = r.json()["object"]["sha"]
+
+    # Create a new branch in the fork
+    r = await client.post(
+        f"/repos/{fork_owner}/{fork_name}/git/refs",
+        headers=headers,
+        json={"ref": f"refs/heads/{new_branch}", "sha": env.GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH},
+    )
+    r.raise_for_status()
+
+    # Commit file contents to the new branch
+    r = await client.put(
+        f"/repos/{fork_owner}/{fork_name}/contents/{file_path}",
+        headers=headers,
+        json={
+            "message": message,
+            "content": base64.b64encode(file_content).decode("utf-8"),
+            "branch": new_branch,
+        },
+    )
+    r.raise_for_status()
+    return r.json()["commit"]["sha"]
+
+
+# Multiple of 3, so that the base64 of each chunk can be concatenated without padding in between
+BLOB_CHUNK_SIZE = 3 * 64 * 1024
+
+_base_tree_sha: str | None = None
+
+
+async def _iter_blob_body(file_content: bytes) -> AsyncIterator[bytes]:
+    yield b'{"encoding":"base64","content":"'
+    view = memoryview(file_content)
+    for i in range(0, len(view), BLOB_CHUNK_SIZE):
+        yield base64.b64encode(view[i : i + BLOB_CHUNK_SIZE])
+    yield b'"}'
 
-        # Commit file contents to the new branch
-        r = await client.put(
-            f"https://api.github.com/repos/{fork_owner}/{fork_name}/contents/{file_path}",
+
+async def _get_base_tree_sha(headers: dict[str, str], fork_owner: str, fork_name: str) -> str:
+    """Get the tree of the data branch's first commit, commits are immutable so it is only fetched once."""
+    global _base_tree_sha
+
+    if _base_tree_sha is None:
+        r = await get_client().get(
+            f"/repos/{fork_owner}/{fork_name}/git/commits/{env.GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH}",
             headers=headers,
-            json={
-                "message": f"Add {file_path}",
-                "content": base64.b64encode(file_content).decode("utf-8"),
-                "branch": new_branch,
-            },
         )
         r.raise_for_status()
-        commit_hash: str = r.json()["commit"]["sha"]
+        _base_tree_sha = r.json()["tree"]["sha"]
+
+    return _base_tree_sha
 
-        # Open PR against upstream
+
+async def _commit_with_git_data_api(
+    headers: dict[str, str],
+    fork_owner: str,
+    fork_name: str,
+    new_branch: str,
+    files: dict[str, bytes],
+    message: str,
+) -> str:
+    client = get_client()
+    repo_url = f"/repos/{fork_owner}/{fork_name}"
+
+    async def create_blob(file_content: bytes) -> str:
+        # Base64 encoded chunk by chunk while it is being sent
+        body_length = len(b'{"encoding":"base64","content":""}') + 4 * -(-len(file_content) // 3)
         r = await client.post(
-            f"https://api.github.com/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/pulls",
-            headers=root_headers,
-            json={
-                "title": pr_title,
-                "head": f"{fork_owner}:{new_branch}",
-                "head_repo": fork_name,
-                "base": env.GIT_UPSTREAM_DATA_BRANCH,
-                "maintainer_can_modify": False,
-            },
+            f"{repo_url}/git/blobs",
+            headers=headers | {"Content-Type": "application/json", "Content-Length": str(body_length)},
+            content=_iter_blob_body(file_content),
         )
         r.raise_for_status()
+        return r.json()["sha"]
+
+    # Upload the files as blobs, concurrently over the one HTTP/2 connection
+    blob_shas = await asyncio.gather(*(create_blob(file_content) for file_content in files.values()))
+
+    # Put the blobs in a tree on top of the data branch's first commit
+    r = await client.post(
+        f"{repo_url}/git/trees",
+        headers=headers,
+        json={
+            "base_tree": await _get_base_tree_sha(headers, fork_owner, fork_name),
+            "tree": [
+                {"path": file_path, "mode": "100644", "type": "blob", "sha": blob_sha}
+                for file_path, blob_sha in zip(files, blob_shas, strict=True)
+            ],
+        },
+    )
+    r.raise_for_status()
+    tree_sha = r.json()["sha"]
+
+    r = await client.post(
+        f"{repo_url}/git/commits",
+        headers=headers,
+        json={
+            "message": message,
+            "tree": tree_sha,
+            "parents": [env.GIT_UPSTREAM_DATA_BRANCH_FIRST_COMMIT_HASH],
+        },
+    )
+    r.raise_for_status()
+    commit_hash: str = r.json()["sha"]
+
+    # Point the new branch at the commit
+    r = await client.post(
+        f"{repo_url}/git/refs",
+        headers=headers,
+        json={"ref": f"refs/heads/{new_branch}", "sha": commit_hash},
+    )
+    r.raise_for_status()
 
     return commit_hash
+
+
+COMMIT_ENGINES = {
+    "contents": _commit_with_contents_api,
+    "git-data": _commit_with_git_data_api,
+}
+
+
+async def commit_files(
+    app_installation_token: str,
+    fork_owner: str,
+    fork_name: str,
+    new_branch: str,
+    files: dict[str, bytes],
+    message: str,
+) -> str:
+    """Commit files (path -> content) to a new fork branch on top of the data branch's first commit, in one commit.
+
+    Uses the configured engine, only `git-data` can commit more than one file.
+    """
+    headers = {"Authorization": f"token {app_installation_token}"}
+
+    commit = COMMIT_ENGINES[env.GITHUB_COMMIT_ENGINE]
+    return await commit(
+        headers,
+        fork_owner=fork_owner,
+        fork_name=fork_name,
+        new_branch=new_branch,
+        files=files,
+        message=message,
+    )
+
+
+async def create_pull_request(
+    root_app_installation_token: str,
+    fork_owner: str,
+    fork_name: str,
+    branch: str,
+    pr_title: str,
+) -> None:
+    """Open a PR against the upstream data branch, an already open PR for the branch counts as success."""
+    root_headers = {"Authorization": f"token {root_app_installation_token}"}
+
+    r = await get_client().post(
+        f"/repos/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/pulls",
+        headers=root_headers,
+        json={
+            "title": pr_title,
+            "head": f"{fork_owner}:{branch}",
+            "head_repo": fork_name,
+            "base": env.GIT_UPSTREAM_DATA_BRANCH,
+            "maintainer_can_modify": False,
+        },
+    )
+    if r.status_code == 422 and "pull request already exists" in r.text:
+        return
+
+    r.raise_for_status()
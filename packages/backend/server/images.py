@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from . import env
+
+log = logging.getLogger(__name__)
+
+ACCEPTED_FORMATS = ["WEBP", "PNG", "JPEG"]
+# Tried in order until the encoded image fits the byte budget, then the image is scaled down
+WEBP_QUALITIES = [70, 60, 50, 40]
+DOWNSCALE_FACTOR = 0.75
+WEBP_METHOD = 4
+# Width (and height) of the perceptual hash's grid of brightness comparisons, 64 bits
+DHASH_SIZE = 8
+# Longer side of the smaller versions committed next to each artwork, for the gallery to show from afar
+VARIANT_SIZES = [128, 512]
+VARIANTS_DIR = "variants"
+
+_pool: ProcessPoolExecutor | None = None
+_metrics: Counter[str] = Counter()
+_max_time = 0.0
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+@dataclass
+class ProcessedImage:
+    data: bytes
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    quality: int
+    # Of `data`, the same image is the same canonical WebP however it was uploaded
+    sha256: str
+    # Perceptual hash, close for images that look alike, see `dhash`
+    dhash: int
+    decode_time: float
+    encode_time: float
+
+
+def _open(source: bytes | Path) -> Image.Image:
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source, formats=ACCEPTED_FORMATS)
+
+
+def _decode(source: bytes | Path, max_pixels: int) -> Image.Image:
+    too_large = f"Image has more than {max_pixels} pixels"
+    try:
+        with _open(source) as image:
+            # Only the header is read so far, a decompression bomb is turned away before it is decoded
+            if image.width * image.height > max_pixels:
+                raise InvalidImageError(too_large)
+            image.verify()
+
+        # `verify` leaves the image unusable, it has to be opened again to be decoded
+        with _open(source) as image:
+            image.load()
+            # Canvas exports don't have an orientation, other images might
+            image = ImageOps.exif_transpose(image)
+    except InvalidImageError:
+        # A `ValueError` too, it mustn't be taken for a corrupt image below
+        raise
+    except Image.DecompressionBombError as e:
+        # Pillow's own, much higher, limit is checked when opening
+        raise InvalidImageError(too_large) from e
+    except UnidentifiedImageError as e:
+        msg = "Only WebP, PNG and JPEG images are accepted"
+        raise InvalidImageError(msg) from e
+    except (OSError, SyntaxError, ValueError) as e:
+        msg = "Image is corrupt or truncated"
+        raise InvalidImageError(msg) from e
+
+    mode = "RGBA" if image.has_transparency_data else "RGB"
+    # Rebuilt from the bare pixels, leaving EXIF, ICC profiles, XMP and any other metadata behind
+    return Image.frombytes(mode, image.size, image.convert(mode).tobytes())
+
+
+def _encode(image: Image.Image, max_bytes: int) -> tuple[bytes, Image.Image, int]:
+    while True:
+        for quality in WEBP_QUALITIES:
+            buffer = io.BytesIO()
+            image.save(buffer, format="WEBP", quality=quality, method=WEBP_METHOD)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue(), image, quality
+
+        if min(image.size) <= 1:
+            msg = f"Image doesn't fit in {max_bytes} bytes"
+            raise InvalidImageError(msg)
+        image = image.resize(
+            (max(1, int(image.width * DOWNSCALE_FACTOR)), max(1, int(image.height * DOWNSCALE_FACTOR))),
+            Image.Resampling.LANCZOS,
+        )
+
+
+def dhash(image: Image.Image) -> int:
+    """Get the difference hash of an image, as a signed 64-bit integer like Postgres' BIGINT stores it.
+
+    Each bit tells whether a cell of a `DHASH_SIZE` grid is brighter than the one to its right, which barely changes
+    with small edits, scaling or re-encoding. Transparent pixels are flattened onto white, whatever color they hold.
+    """
+    small = image.convert("RGBA").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BOX)
+    background = Image.new("RGBA", small.size, (255, 255, 255, 255))
+    pixels = list(Image.alpha_composite(background, small).convert("L").getdata())
+
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            i = row * (DHASH_SIZE + 1) + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def process_image(source: bytes | Path, max_pixels: int, max_dimension: int, max_bytes: int) -> ProcessedImage:
+    """Decode and verify an image, given as bytes or a file, and re-encode it as a canonical WebP without metadata.
+
+    The image is scaled down to at most `max_dimension` pixels on its longer side, and further until it fits in
+    `max_bytes`. Runs in the worker processes, the limits are passed in rather than read from `env`.
+    """
+    start = time.perf_counter()
+    image = _decode(source, max_pixels)
+    original_width, original_height = image.size
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    decode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded, image, quality = _encode(image, max_bytes)
+    encode_time = time.perf_counter() - start
+
+    return ProcessedImage(
+        data=encoded,
+        width=image.width,
+        height=image.height,
+        original_width=original_width,
+        original_height=original_height,
+        quality=quality,
+        sha256=hashlib.sha256(encoded).hexdigest(),
+        dhash=dhash(image),
+        decode_time=decode_time,
+        encode_time=encode_time,
+    )
+
+
+def resize_image(data: bytes, sizes: list[int]) -> dict[int, bytes]:
+    """Scale a processed image down to each of `sizes` pixels on its longer side, skipping sizes it isn't larger than.
+
+    The image is one `process_image` made, so it is trusted, and the same image always gives the same variants.
+    """
+    with Image.open(io.BytesIO(data), formats=["WEBP"]) as image:
+        image.load()
+
+        variants = {}
+        for size in sizes:
+            if max(image.size) <= size:
+                continue
+
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            variant.save(buffer, format="WEBP", quality=WEBP_QUALITIES[0], method=WEBP_METHOD)
+            variants[size] = buffer.getvalue()
+
+    return variants
+
+
+def variant_path(size: int, filename: str) -> str:
+    return f"{VARIANTS_DIR}/{size}/{filename}"
+
+
+async def start_pool() -> None:
+    """Start the worker processes, the first image shouldn't have to wait for them to import Pillow."""
+    global _pool
+
+    # Forking a process with running threads and an event loop isn't safe
+    _pool = ProcessPoolExecutor(max_workers=env.IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(_pool, Image.init) for _ in range(env.IMAGE_WORKERS)))
+
+
+def stop_pool() -> None:
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def process(source: bytes | Path) -> ProcessedImage:
+    """Process an uploaded image in a worker process, raises `InvalidImageError` if it isn't acceptable.
+
+    An upload on disk is passed by its path, the worker reads it without it going through this process.
+    """
+    global _max_time
+
+    if _pool is None:
+        msg = "Image process pool is not started."
+        raise RuntimeError(msg)
+
+    start = time.perf_counter()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            _pool,
+            process_image,
+            source,
+            env.IMAGE_MAX_PIXELS,
+            env.IMAGE_MAX_DIMENSION,
+            env.IMAGE_MAX_BYTES,
+        )
+    except InvalidImageError:
+        _metrics["rejected"] += 1
+        raise
+    elapsed = time.perf_counter() - start
+
+    _metrics["processed"] += 1
+    size = len(source) if isinstance(source, bytes) else source.stat().st_size
+    _metrics["bytes_in"] += size
+    _metrics["bytes_out"] += len(result.data)
+    _metrics["total_ms"] += round(elapsed * 1000)
+    _metrics["decode_ms"] += round(result.decode_time * 1000)
+    _metrics["encode_ms"] += round(result.encode_time * 1000)
+    _max_time = max(_max_time, elapsed)
+    log.debug(
+        "Processed a %dx%d image into %dx%d at quality %d (%d -> %d bytes) in %.0f ms",
+        result.original_width,
+        result.original_height,
+        result.width,
+        result.height,
+        result.quality,
+        size,
+        len(result.data),
+        elapsed * 1000,
+    )
+
+    return result
+
+
+async def make_variants(data: bytes) -> dict[int, bytes]:
+    """Make the `VARIANT_SIZES` variants of a processed image in a worker process, by size."""
+    if _pool is None:
+        msg = "Image process pool is not started."
+        raise RuntimeError(msg)
+
+    start = time.perf_counter()
+    variants = await asyncio.get_running_loop().run_in_executor(_pool, resize_image, data, VARIANT_SIZES)
+    _metrics["variants"] += len(variants)
+    _metrics["variant_bytes"] += sum(len(variant) for variant in variants.values())
+    _metrics["variant_ms"] += round((time.perf_counter() - start) * 1000)
+
+    return variants
+
+
+def get_stats() -> dict[str, Any]:
+    return {**_metrics, "max_ms": round(_max_time * 1000)}
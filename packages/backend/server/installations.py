@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import logging
+from typing import Any
+
+from . import env, gh, pg, tokens
+
+log = logging.getLogger(__name__)
+
+# Lowercased account login -> installation id, GitHub logins are case-insensitive
+_by_login: dict[str, int] = {}
+_sync_task: asyncio.Task[None] | None = None
+
+
+async def load() -> None:
+    """Load the installation index from Postgres."""
+    _by_login.clear()
+    _by_login.update(await pg.github_installations_get_all())
+
+
+async def sync() -> None:
+    """Rebuild the installation index from all pages of the GitHub App's installations."""
+    installations = [
+        (installation["account"]["login"].lower(), installation["id"])
+        for installation in await gh.get_app_installations(tokens.get_app_token())
+        if installation["suspended_at"] is None
+    ]
+    await pg.github_installations_replace_all(installations)
+
+    _by_login.clear()
+    _by_login.update(installations)
+
+
+async def _sync_in_background() -> None:
+    try:
+        await sync()
+    except Exception:
+        log.exception("Failed to sync the GitHub App installation index")
+
+
+def start_sync() -> None:
+    global _sync_task
+
+    _sync_task = asyncio.create_task(_sync_in_background())
+
+
+async def stop_sync() -> None:
+    global _sync_task
+
+    if _sync_task is not None:
+        _sync_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _sync_task
+        _sync_task = None
+
+
+async def add(account_login: str, installation_id: int) -> None:
+    await pg.github_installations_upsert(account_login, installation_id)
+    _by_login[account_login.lower()] = installation_id
+
+
+async def remove(installation_id: int) -> None:
+    await pg.github_installations_delete(installation_id)
+    for account_login, indexed_installation_id in list(_by_login.items()):
+        if indexed_installation_id == installation_id:
+            del _by_login[account_login]
+
+    tokens.invalidate_installation_token(installation_id)
+
+
+async def get_installation_id(account_login: str) -> int | None:
+    """Get the GitHub App installation id of an account.
+
+    Looks in memory first, then Postgres (e.g. when another worker received the webhook), and only asks GitHub for
+    accounts the index doesn't know about yet.
+    """
+    installation_id = _by_login.get(account_login.lower())
+    if installation_id is not None:
+        return installation_id
+
+    installation_id = await pg.github_installations_get(account_login)
+    if installation_id is not None:
+        _by_login[account_login.lower()] = installation_id
+        return installation_id
+
+    installation = await gh.get_user_installation(account_login, tokens.get_app_token())
+    if installation is None or installation["suspended_at"] is not None:
+        return None
+
+    await add(account_login, installation["id"])
+    return installation["id"]
+
+
+def verify_webhook_signature(body: bytes, signature: str | None) -> bool:
+    """Check the `X-Hub-Signature-256` header of a GitHub webhook delivery."""
+    if env.GITHUB_WEBHOOK_SECRET is None or signature is None:
+        return False
+
+    expected = "sha256=" + hmac.new(env.GITHUB_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+async def handle_webhook_event(event: str, payload: dict[str, Any]) -> None:
+    """Keep the index current from `installation` and `installation_target` webhook events."""
+    action = payload.get("action")
+
+    if event == "installation":
+        installation = payload["installation"]
+        if action in ("deleted", "suspend"):
+            await remove(installation["id"])
+        elif action in ("created", "unsuspend", "new_permissions_accepted"):
+            await add(installation["account"]["login"], installation["id"])
+
+    elif event == "installation_target" and action == "renamed":
+        installation_id = payload["installation"]["id"]
+        await remove(installation_id)
+        await add(payload["account"]["login"], installation_id)
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        "installations_indexed": len(_by_login),
+    }
@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import logging
+from collections import Counter
+from uuid import UUID
+
+import httpx
+
+from . import env, gh, images, listing, pg, registry, signing, similarity, tokens
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5
+# A running job whose worker hasn't finished it within this many seconds is assumed dead and claimed again
+LOCK_TIMEOUT = 10 * 60
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 5 * 60
+
+_workers: list[asyncio.Task[None]] = []
+_wakeup = asyncio.Event()
+_metrics: Counter[str] = Counter()
+
+
+class NearDuplicateError(Exception):
+    """The user published, or is publishing, an artwork that looks almost the same."""
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(f"Too similar to {filename}")
+        self.filename = filename
+
+
+async def find_duplicate(content_sha256: str) -> tuple[UUID | None, str] | None:
+    """Get the job id and filename of an artwork with the same content, if it is published or being published.
+
+    The job id is `None` when it is published already. Only asks Postgres, so it can turn a duplicate away before
+    anything is asked of GitHub.
+    """
+    published = await pg.github_files_find_by_content(content_sha256)
+    if published is not None:
+        _metrics["duplicates_published"] += 1
+        return None, published
+
+    active = await pg.publish_jobs_find_active(content_sha256)
+    if active is not None:
+        _metrics["duplicates_in_progress"] += 1
+        return active
+
+    return None
+
+
+async def check_near_duplicate(username: str, content_sha256: str, dhash: int) -> None:
+    """Raise `NearDuplicateError` when the user's artwork only differs slightly from another of theirs.
+
+    Nearly blank artworks are never compared. Only asks Postgres and the similarity index.
+    """
+    if env.PUBLISH_NEAR_DUPLICATE_DISTANCE < 0 or not similarity.is_distinctive(dhash):
+        return
+
+    # Published ones are in the similarity index, the ones still being published only in their jobs
+    near_duplicate = similarity.find_by_user(username, dhash, env.PUBLISH_NEAR_DUPLICATE_DISTANCE)
+    if near_duplicate is None:
+        near_duplicate = await pg.publish_jobs_find_similar(
+            username, dhash, env.PUBLISH_NEAR_DUPLICATE_DISTANCE, content_sha256
+        )
+    if near_duplicate is not None:
+        _metrics["near_duplicates_rejected"] += 1
+        raise NearDuplicateError(near_duplicate)
+
+
+async def enqueue(
+    username: str,
+    installation_id: int,
+    fork_name: str,
+    filename: str,
+    image: bytes,
+    content_sha256: str,
+    dhash: int,
+) -> tuple[UUID, str]:
+    """Persist a publish job, it is picked up by a worker of any backend process.
+
+    Returns the job's id and the artwork's filename. Duplicates are looked for with `find_duplicate` first, a job with
+    the same content enqueued in the meantime is returned instead of a new one.
+    """
+    job_id, filename, inserted = await pg.publish_jobs_insert(
+        username=username,
+        installation_id=installation_id,
+        fork_name=fork_name,
+        filename=filename,
+        image=image,
+        content_sha256=content_sha256,
+        dhash=dhash,
+    )
+    if not inserted:
+        _metrics["duplicates_in_progress"] += 1
+        return job_id, filename
+
+    _metrics["enqueued"] += 1
+    _wakeup.set()
+
+    return job_id, filename
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        # 403 and 429 are GitHub's (secondary) rate limits
+        return e.response.status_code >= 500 or e.response.status_code in (403, 429)
+
+    return isinstance(e, httpx.TransportError)
+
+
+async def _run(job: pg.PublishJob) -> None:
+    branch = job.branch
+    commit_hash = job.commit_hash
+    # Committed before the column existed when `None`, i.e. without variants
+    variant_sizes = job.variants or []
+
+    if commit_hash is None:
+        if job.content_sha256 is not None and await pg.github_files_find_by_content(job.content_sha256) is not None:
+            # Recorded by a job that finished just as this one was enqueued
+            _metrics["duplicates_published"] += 1
+            await pg.publish_jobs_finish(job.id)
+            return
+
+        await pg.publish_jobs_set_stage(job.id, "committing")
+        assert job.image is not None
+
+        # A previous attempt might have gotten as far as creating the branch
+        branch = job.filename.removesuffix(".webp")
+        if job.attempts > 1:
+            branch = f"{branch}-{job.attempts}"
+
+        files = {job.filename: job.image}
+        # The Contents API can only commit the artwork alone
+        if env.GITHUB_COMMIT_ENGINE == "git-data":
+            variants = await images.make_variants(job.image)
+            files |= {images.variant_path(size, job.filename): variant for size, variant in variants.items()}
+            variant_sizes = sorted(variants)
+
+        message = f"Add {job.filename}"
+        if env.PUBLISH_HMAC_SECRET:
+            # Lets the data branch workflow verify the PR without asking the backend
+            blob_shas = {path: signing.git_blob_sha(content) for path, content in files.items()}
+            message = signing.add_trailer(message, signing.sign(env.PUBLISH_HMAC_SECRET, blob_shas))
+
+        commit_hash = await gh.commit_files(
+            app_installation_token=await tokens.get_installation_token(job.installation_id),
+            fork_owner=job.github_username,
+            fork_name=job.fork_name,
+            new_branch=branch,
+            files=files,
+            message=message,
+        )
+        await pg.publish_jobs_set_commit(job.id, branch, commit_hash, variant_sizes)
+
+    assert branch is not None
+
+    # Recorded before the PR is opened, the data branch workflow verifies it as soon as it is
+    await pg.publish_jobs_set_stage(job.id, "recording")
+    recorded = await pg.github_files_insert_row(
+        username=job.github_username,
+        filename=job.filename,
+        commit_hash=commit_hash,
+        variants=variant_sizes,
+        content_sha256=job.content_sha256,
+        dhash=job.dhash,
+    )
+    if not recorded:
+        # A job with the same content finished in the meantime, it opens the only PR for it
+        _metrics["duplicates_published"] += 1
+        await pg.publish_jobs_finish(job.id)
+        return
+
+    registry.add(job.filename, commit_hash)
+    similarity.add(job.github_username, job.filename, job.dhash)
+    listing.invalidate()
+
+    await pg.publish_jobs_set_stage(job.id, "opening_pull_request")
+    await gh.create_pull_request(
+        root_app_installation_token=await tokens.get_installation_token(env.GIT_UPSTREAM_APP_INSTALLATION_ID),
+        fork_owner=job.github_username,
+        fork_name=job.fork_name,
+        branch=branch,
+        pr_title=f"Publish {job.filename}",
+    )
+
+    await pg.publish_jobs_finish(job.id)
+
+
+async def _process(job: pg.PublishJob) -> None:
+    try:
+        await _run(job)
+    except asyncio.CancelledError:
+        # Shutting down, hand the job to whichever worker is up next
+        await asyncio.shield(pg.publish_jobs_retry(job.id, "Interrupted", delay=0))
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if _is_retryable(e) and job.attempts < env.PUBLISH_JOB_MAX_ATTEMPTS:
+            delay = min(RETRY_BASE_DELAY * 2 ** (job.attempts - 1), RETRY_MAX_DELAY)
+            log.warning("Publish job %s failed (attempt %d), retrying in %d s: %s", job.id, job.attempts, delay, error)
+            _metrics["retried"] += 1
+            await pg.publish_jobs_retry(job.id, error, delay)
+        else:
+            log.exception("Publish job %s failed", job.id)
+            _metrics["failed"] += 1
+            await pg.publish_jobs_fail(job.id, error)
+    else:
+        _metrics["done"] += 1
+
+
+async def _work() -> None:
+    while True:
+        _wakeup.clear()
+        try:
+            job = await pg.publish_jobs_claim(LOCK_TIMEOUT)
+        except Exception:
+            log.exception("Failed to claim a publish job")
+            job = None
+
+        if job is None:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL)
+            continue
+
+        await _process(job)
+
+
+def start_workers() -> None:
+    for _ in range(env.PUBLISH_WORKERS):
+        _workers.append(asyncio.create_task(_work()))
+
+
+async def stop_workers() -> None:
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "workers": len(_workers),
+    }
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+
+import brotli
+import orjson
+
+from . import env, pg
+
+log = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 1000
+GZIP_LEVEL = 6
+# Higher qualities take seconds for a large listing, for little gain on JSON this repetitive
+BROTLI_QUALITY = 5
+
+_PREFIX = b'{"artworks":['
+
+
+class ManifestEncoder:
+    """The artwork listing as encoded JSON, appending a row only encodes (and gzips) that row.
+
+    `rows` and `slots` are append-only, snapshots share them and only look at their first `total` rows.
+    """
+
+    def __init__(self) -> None:
+        self.rows: list[tuple[int, str, str, list[int]]] = []
+        # Filename (without the CHAR padding) -> slot, i.e. position in `rows`
+        self.slots: dict[str, int] = {}
+        self._body = bytearray(_PREFIX)
+        self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._gzip_chunks = [self._gzip.compress(_PREFIX)]
+
+    def append(self, rows: list[tuple[int, str, str, list[int]]]) -> None:
+        for row in rows:
+            _, username, filename, variants = row
+            fragment = (b"," if self.rows else b"") + orjson.dumps([username, filename, variants])
+
+            self.slots[filename.rstrip()] = len(self.rows)
+            self.rows.append(row)
+            self._body += fragment
+            # Mostly empty, zlib buffers until it has a block worth emitting
+            if chunk := self._gzip.compress(fragment):
+                self._gzip_chunks.append(chunk)
+
+    def encode(self) -> tuple[bytes, bytes]:
+        """Get the listing as a whole, plain and gzipped, in the shape of `ArtworksResponse`."""
+        suffix = b"]," + orjson.dumps(
+            {
+                "cursor": self.rows[-1][0] if self.rows else 0,
+                "has_more": False,
+                "total": len(self.rows),
+            }
+        ).removeprefix(b"{")
+
+        # Finish a copy of the compressor, the original keeps going with the next appended rows
+        gzip = self._gzip.copy()
+        gzip_body = b"".join(self._gzip_chunks) + gzip.compress(suffix) + gzip.flush()
+
+        return bytes(self._body) + suffix, gzip_body
+
+
+@dataclass
+class Snapshot:
+    encoder: ManifestEncoder
+    total: int
+    version: tuple[int, int]
+    body: bytes
+    gzip_body: bytes
+    # Compressed in the background, gzip is served instead until it is done
+    brotli_body: bytes | None = None
+
+    def get_row(self, slot: int) -> tuple[int, str, str, list[int]]:
+        return self.encoder.rows[slot]
+
+    def get_slot(self, filename: str) -> int | None:
+        slot = self.encoder.slots.get(filename.rstrip())
+        return slot if slot is not None and slot < self.total else None
+
+
+_encoder: ManifestEncoder | None = None
+_snapshot: Snapshot | None = None
+# Monotonic time of the last check against Postgres
+_checked_at = float("-inf")
+_lock = asyncio.Lock()
+_brotli_task: asyncio.Task[None] | None = None
+# The newest snapshot still to be compressed with brotli
+_brotli_pending: Snapshot | None = None
+_metrics: Counter[str] = Counter()
+
+
+async def _compress_brotli() -> None:
+    global _brotli_pending
+
+    while _brotli_pending is not None:
+        snapshot, _brotli_pending = _brotli_pending, None
+        try:
+            snapshot.brotli_body = await asyncio.to_thread(brotli.compress, snapshot.body, quality=BROTLI_QUALITY)
+            _metrics["brotli_builds"] += 1
+        except Exception:
+            log.exception("Failed to compress the artwork listing with brotli")
+
+
+def _build(encoder: ManifestEncoder, version: tuple[int, int]) -> Snapshot:
+    global _brotli_task, _brotli_pending
+
+    body, gzip_body = encoder.encode()
+    snapshot = Snapshot(
+        encoder=encoder,
+        total=len(encoder.rows),
+        version=version,
+        body=body,
+        gzip_body=gzip_body,
+    )
+
+    # One compression at a time, a running one can't be stopped. Whatever snapshot is newest when it's done is
+    # compressed next, so a burst of inserts doesn't queue up a compression each
+    _brotli_pending = snapshot
+    if _brotli_task is None or _brotli_task.done():
+        _brotli_task = asyncio.create_task(_compress_brotli())
+
+    return snapshot
+
+
+async def _refresh(version: tuple[int, int]) -> Snapshot:
+    global _encoder
+
+    if _encoder is not None and _snapshot is not None and version[1] > _snapshot.total:
+        last_id = _snapshot.get_row(_snapshot.total - 1)[0] if _snapshot.total else 0
+        new_rows = await pg.github_files_get_since(last_id, version[1] - _snapshot.total + 1)
+
+        # Rows are only appended, ids being in commit order, unless one was deleted by hand
+        if _snapshot.total + len(new_rows) == version[1]:
+            _encoder.append(new_rows)
+            _metrics["appends"] += 1
+            return _build(_encoder, version)
+
+    _encoder = ManifestEncoder()
+    _encoder.append(await pg.github_files_get_all())
+    _metrics["reloads"] += 1
+    return _build(_encoder, version)
+
+
+async def get_snapshot() -> Snapshot:
+    """Get the artwork listing, only going to Postgres when the snapshot is older than `ARTWORKS_SNAPSHOT_TTL`.
+
+    An old snapshot is re-validated with the table's highest id and row count. When those changed, only the new rows
+    are loaded and encoded.
+    """
+    global _snapshot, _checked_at
+
+    if _snapshot is not None and time.monotonic() - _checked_at < env.ARTWORKS_SNAPSHOT_TTL:
+        _metrics["hits"] += 1
+        return _snapshot
+
+    async with _lock:
+        # Another request might have re-validated it while this one was waiting
+        if _snapshot is not None and time.monotonic() - _checked_at < env.ARTWORKS_SNAPSHOT_TTL:
+            _metrics["hits"] += 1
+            return _snapshot
+
+        version = await pg.github_files_get_version()
+        if _snapshot is None or version != _snapshot.version:
+            _snapshot = await _refresh(version)
+        else:
+            _metrics["revalidations"] += 1
+        _checked_at = time.monotonic()
+
+        return _snapshot
+
+
+def get_range(snapshot: Snapshot, offset: int, limit: int) -> tuple[list[tuple[int, str, str, list[int]]], int]:
+    """Get the rows of slots `offset` up to `offset + limit` and the id of the last row at or before the range end."""
+    end = min(offset + limit, snapshot.total)
+    _metrics["ranges"] += 1
+
+    return snapshot.encoder.rows[offset:end], snapshot.encoder.rows[end - 1][0] if end > 0 else 0
+
+
+async def get_since(since_id: int, limit: int) -> tuple[list[tuple[int, str, str, list[int]]], bool]:
+    """Get up to `limit` rows inserted after the row with id `since_id`, and whether there are more.
+
+    Ids are in commit order (see `pg.github_files_insert_row`), a row can't turn up behind a cursor handed out before.
+    """
+    rows = await pg.github_files_get_since(since_id, limit + 1)
+    _metrics["deltas"] += 1
+
+    return rows[:limit], len(rows) > limit
+
+
+def invalidate() -> None:
+    """Make the next request re-validate the snapshot, e.g. after inserting an artwork."""
+    global _checked_at
+
+    _checked_at = float("-inf")
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    # Proxies compressing the response weaken the ETag, If-None-Match uses weak comparison anyway
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def negotiate(snapshot: Snapshot, accept_encoding: str | None) -> str | None:
+    """Pick the `Content-Encoding` of the smallest variant of the listing the client accepts, `None` for identity."""
+    accepted: dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    if snapshot.brotli_body is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+def get_etag(snapshot: Snapshot, content_encoding: str | None) -> str:
+    """Get the strong ETag of a variant of the listing, the same in every backend process for the same listing.
+
+    Variants aren't byte-identical, so each has its own, or a cache could answer with a body in another encoding.
+    """
+    suffix = f"-{content_encoding}" if content_encoding is not None else ""
+    return f'"{snapshot.version[0]}-{snapshot.version[1]}{suffix}"'
+
+
+def get_body(snapshot: Snapshot, content_encoding: str | None) -> bytes:
+    if content_encoding == "br" and snapshot.brotli_body is not None:
+        _metrics["served_br"] += 1
+        return snapshot.brotli_body
+    if content_encoding == "gzip":
+        _metrics["served_gzip"] += 1
+        return snapshot.gzip_body
+
+    _metrics["served_identity"] += 1
+    return snapshot.body
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "rows": _snapshot.total if _snapshot is not None else 0,
+        "bytes": len(_snapshot.body) if _snapshot is not None else 0,
+        "gzip_bytes": len(_snapshot.gzip_body) if _snapshot is not None else 0,
+        "brotli_bytes": len(_snapshot.brotli_body or b"") if _snapshot is not None else 0,
+    }
@@ -0,0 +1,138 @@
+"""Dump the artwork listing into a static, sharded manifest for the gallery to load before asking the backend.
+
+The manifest is `manifest.json`, holding the number of artworks in it, the id of the newest one (the high-water mark)
+and the names of its shards. Every shard holds `shard_size` slots (the last one possibly fewer) as
+`{"artworks": [[username, filename, variants], ...]}`, the same rows `/artworks` returns, and is named after a hash of
+its content. So full shards keep their names across runs and can be cached forever, only the last shard and
+`manifest.json` itself change as artworks are published.
+
+Only needs the standard library when reading the listing from the backend, so it runs as a plain script, e.g. in the
+static deploy workflow:
+
+    python packages/backend/server/manifest.py --source https://cj12.matiiss.com/api/artworks --output out/manifest
+
+With `--source postgres` the `github_files` table is read directly, with the same `POSTGRES_*` variables as the
+backend, which needs `psycopg`.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import urllib.request
+from pathlib import Path
+from typing import Any
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+SHARD_PREFIX = "artworks-"
+# Same as the most `/artworks` returns at once, the gallery fetches this many slots at a time
+DEFAULT_SHARD_SIZE = 1000
+REQUEST_TIMEOUT = 60
+
+
+def load_from_backend(url: str) -> tuple[list[list[Any]], int]:
+    """Get the rows and high-water id of the whole listing, from the backend's `/artworks`."""
+    request = urllib.request.Request(url, headers={"Accept": "application/json"})  # noqa: S310
+    with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:  # noqa: S310
+        data = json.load(response)
+
+    return data["artworks"], data["cursor"]
+
+
+def load_from_postgres() -> tuple[list[list[Any]], int]:
+    """Get the rows and high-water id of the whole listing, from the `github_files` table."""
+    # Not importing `pg`, that would need the whole backend and its configuration
+    import psycopg  # noqa: PLC0415
+    from psycopg.conninfo import make_conninfo  # noqa: PLC0415
+
+    conninfo = make_conninfo(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=os.getenv("POSTGRES_PORT", "5432"),
+    )
+    with psycopg.connect(conninfo) as conn:
+        rows = conn.execute(
+            """
+            SELECT
+                id,
+                github_username,
+                filename,
+                variants
+            FROM
+                github_files
+            ORDER BY
+                id ASC
+            """
+        ).fetchall()
+
+    return [[username, filename, variants] for _, username, filename, variants in rows], rows[-1][0] if rows else 0
+
+
+def encode_shard(rows: list[list[Any]]) -> bytes:
+    return json.dumps({"artworks": rows}, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def write_manifest(rows: list[list[Any]], high_water: int, output: Path, shard_size: int) -> dict:
+    """Write the shards and then `manifest.json` into `output`, removing the shards no longer referenced."""
+    output.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    for offset in range(0, len(rows), shard_size):
+        body = encode_shard(rows[offset : offset + shard_size])
+        name = f"{SHARD_PREFIX}{hashlib.sha256(body).hexdigest()[:16]}.json"
+        shard_path = output / name
+        if not shard_path.exists():
+            shard_path.write_bytes(body)
+        shards.append(name)
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "high_water": high_water,
+        "total": len(rows),
+        "shard_size": shard_size,
+        "shards": shards,
+    }
+    # Written last and replaced at once, so it never points at shards that aren't there yet
+    tmp_path = output / f"{MANIFEST_NAME}.tmp"
+    tmp_path.write_text(json.dumps(manifest, separators=(",", ":")))
+    tmp_path.replace(output / MANIFEST_NAME)
+
+    for path in output.glob(f"{SHARD_PREFIX}*.json"):
+        if path.name not in shards:
+            path.unlink()
+
+    return manifest
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--source",
+        required=True,
+        help="URL of the backend's /artworks, or 'postgres' to read the github_files table",
+    )
+    parser.add_argument("--output", type=Path, required=True, help="directory to write the manifest into")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE, help="slots per shard")
+    args = parser.parse_args(argv)
+
+    if args.shard_size < 1:
+        parser.error("--shard-size must be positive")
+
+    if args.source == "postgres":
+        rows, high_water = load_from_postgres()
+    else:
+        rows, high_water = load_from_backend(args.source)
+
+    manifest = write_manifest(rows, high_water, args.output, args.shard_size)
+    print(
+        f"Wrote {manifest['total']} artworks (up to id {high_water}) in {len(manifest['shards'])} shards",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+from . import pg
+
+# Arbitrary key for the advisory lock serializing concurrent startups (e.g. multiple uvicorn workers)
+MIGRATIONS_LOCK_KEY = 0x4848_4801
+
+# Append only, a migration's version is its 1-based position in this list
+MIGRATIONS: list[str] = [
+    """
+    CREATE TABLE IF NOT EXISTS github_files (
+        id SERIAL PRIMARY KEY,
+        github_username VARCHAR(39) NOT NULL,
+        filename CHAR(42) NOT NULL,
+        commit_hash CHAR(40) NOT NULL
+    );
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS github_files_filename_commit_hash_key
+        ON github_files (filename, commit_hash);
+    CREATE INDEX IF NOT EXISTS github_files_listing_idx
+        ON github_files (id) INCLUDE (github_username, filename);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS github_installations (
+        account_login VARCHAR(39) PRIMARY KEY,
+        installation_id BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS github_installations_installation_id_idx
+        ON github_installations (installation_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS publish_jobs (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        status VARCHAR(16) NOT NULL DEFAULT 'queued',
+        stage VARCHAR(32) NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        github_username VARCHAR(39) NOT NULL,
+        installation_id BIGINT NOT NULL,
+        fork_name VARCHAR(100) NOT NULL,
+        filename VARCHAR(42) NOT NULL,
+        image BYTEA,
+        branch VARCHAR(64),
+        commit_hash CHAR(40),
+        error TEXT,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+        locked_at TIMESTAMPTZ,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS publish_jobs_active_idx
+        ON publish_jobs (created_at) WHERE status IN ('queued', 'running');
+    """,
+    """
+    ALTER TABLE github_files ADD COLUMN IF NOT EXISTS variants SMALLINT[] NOT NULL DEFAULT '{}';
+    DROP INDEX IF EXISTS github_files_listing_idx;
+    CREATE INDEX IF NOT EXISTS github_files_listing_idx
+        ON github_files (id) INCLUDE (github_username, filename, variants);
+    ALTER TABLE publish_jobs ADD COLUMN IF NOT EXISTS variants SMALLINT[];
+    """,
+    """
+    ALTER TABLE github_files ADD COLUMN IF NOT EXISTS content_sha256 CHAR(64);
+    CREATE UNIQUE INDEX IF NOT EXISTS github_files_content_sha256_key
+        ON github_files (content_sha256);
+    ALTER TABLE publish_jobs ADD COLUMN IF NOT EXISTS content_sha256 CHAR(64);
+    CREATE UNIQUE INDEX IF NOT EXISTS publish_jobs_active_content_sha256_key
+        ON publish_jobs (content_sha256) WHERE status IN ('queued', 'running');
+    """,
+    """
+    ALTER TABLE github_files ADD COLUMN IF NOT EXISTS dhash BIGINT;
+    ALTER TABLE publish_jobs ADD COLUMN IF NOT EXISTS dhash BIGINT;
+    """,
+]
+
+
+async def migrate() -> None:
+    """Apply all migrations newer than the database's current schema version."""
+    async with pg.get_pool().connection() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                """
+            )
+
+            cur = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            row = await cur.fetchone()
+            current_version: int = row[0] if row is not None else 0
+
+            for version, migration in enumerate(MIGRATIONS, start=1):
+                if version <= current_version:
+                    continue
+
+                await conn.execute(migration)
+                await conn.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
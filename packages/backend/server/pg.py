@@ -1,84 +1,583 @@
 import os
+from dataclasses import dataclass
+from uuid import UUID
 
-import psycopg
-from psycopg.rows import tuple_row
+from psycopg import AsyncConnection, AsyncCursor, errors, sql
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import class_row, tuple_row
+from psycopg_pool import AsyncConnectionPool
 
+from . import env
 
-async def get_connection() -> psycopg.AsyncConnection:
-    return await psycopg.AsyncConnection.connect(
+# Notified with a JSON object of every inserted github_files row
+GITHUB_FILES_CHANNEL = "github_files"
+# Arbitrary key for the advisory lock serializing inserts into github_files, so that ids are in commit order
+GITHUB_FILES_INSERT_LOCK_KEY = 0x4848_4802
+
+_pool: AsyncConnectionPool | None = None
+
+
+def get_conninfo() -> str:
+    return make_conninfo(
         dbname=os.getenv("POSTGRES_DB"),
         user=os.getenv("POSTGRES_USER", "postgres"),
         password=os.getenv("POSTGRES_PASSWORD"),
         host=os.getenv("POSTGRES_HOST", "localhost"),
         port=os.getenv("POSTGRES_PORT", "5432"),
-        row_factory=tuple_row,
     )
 
 
-async def github_files_create_table() -> None:
-    async with await get_connection() as conn:
+async def open_pool() -> None:
+    """Open the application-wide connection pool, waiting for `min_size` connections."""
+    global _pool
+
+    _pool = AsyncConnectionPool(
+        get_conninfo(),
+        kwargs={"row_factory": tuple_row},
+        min_size=env.POSTGRES_POOL_MIN_SIZE,
+        max_size=env.POSTGRES_POOL_MAX_SIZE,
+        timeout=env.POSTGRES_POOL_TIMEOUT,
+        max_idle=env.POSTGRES_POOL_MAX_IDLE,
+        check=AsyncConnectionPool.check_connection,
+        name="backend",
+        open=False,
+    )
+    await _pool.open(wait=True)
+
+
+async def close_pool() -> None:
+    global _pool
+
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> AsyncConnectionPool:
+    if _pool is None:
+        msg = "Postgres connection pool is not open."
+        raise RuntimeError(msg)
+    return _pool
+
+
+async def open_listen_connection(channel: str) -> AsyncConnection:
+    """Open a connection outside of the pool listening on `channel`, it has to be kept open to get notified."""
+    conn = await AsyncConnection.connect(get_conninfo(), autocommit=True)
+    await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+    return conn
+
+
+def get_pool_stats() -> dict[str, int]:
+    """Get the connection pool statistics, see `psycopg_pool.AsyncConnectionPool.get_stats`."""
+    return get_pool().get_stats()
+
+
+async def github_files_insert_row(
+    username: str,
+    filename: str,
+    commit_hash: str,
+    variants: list[int],
+    content_sha256: str | None,
+    dhash: int | None,
+) -> bool:
+    """Record a committed artwork, returns `False` if an artwork with the same content was recorded by another job.
+
+    Inserts take turns, each holding a lock from before its id is drawn until it commits. Ids are then in commit
+    order, so whoever has seen an id has seen every lower one too, and "after id n" cursors (the listing's deltas, the
+    feed) never skip a row that committed late.
+    """
+    async with get_pool().connection() as conn:
+        try:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(%s)", (GITHUB_FILES_INSERT_LOCK_KEY,))
+                await conn.execute(
+                    """
+                    WITH inserted AS (
+                        INSERT INTO github_files
+                            (github_username, filename, commit_hash, variants, content_sha256, dhash)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        -- A retried job might have recorded it already, only new rows are notified
+                        ON CONFLICT (filename, commit_hash) DO NOTHING
+                        RETURNING id, github_username, filename, commit_hash, variants, dhash
+                    )
+                    SELECT
+                        pg_notify(
+                            %s,
+                            json_build_object(
+                                'id', id,
+                                'username', github_username,
+                                'filename', filename,
+                                'commit_hash', commit_hash,
+                                'variants', variants,
+                                'dhash', dhash
+                            )::text
+                        )
+                    FROM
+                        inserted
+                    """,
+                    (username, filename, commit_hash, variants, content_sha256, dhash, GITHUB_FILES_CHANNEL),
+                )
+        except errors.UniqueViolation as e:
+            if e.diag.constraint_name != "github_files_content_sha256_key":
+                raise
+            return False
+
+        return True
+
+
+async def github_files_get_pairs() -> list[tuple[str, str]]:
+    async with get_pool().connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS github_files (
-                    id SERIAL PRIMARY KEY,
-                    github_username VARCHAR(39) NOT NULL,
-                    filename CHAR(42) NOT NULL,
-                    commit_hash CHAR(40) NOT NULL
-                );
+                SELECT
+                    filename,
+                    commit_hash
+                FROM
+                    github_files
                 """
             )
-            await conn.commit()
 
+            return await cur.fetchall()
 
-async def github_files_insert_row(username: str, filename: str, commit_hash: str) -> None:
-    await github_files_create_table()
 
-    async with await get_connection() as conn:
+async def github_files_find_existing(pairs: list[tuple[str, str]]) -> set[tuple[str, str]]:
+    """Get which of the `(filename, commit_hash)` pairs are recorded, filenames without their CHAR padding."""
+    async with get_pool().connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
-                INSERT INTO github_files (github_username, filename, commit_hash)
-                VALUES (%s, %s, %s);
+                SELECT
+                    f.filename,
+                    f.commit_hash
+                FROM
+                    github_files f
+                    JOIN unnest(%s::bpchar[], %s::bpchar[]) AS p(filename, commit_hash)
+                        ON f.filename = p.filename
+                        AND f.commit_hash = p.commit_hash
                 """,
-                (username, filename, commit_hash),
+                ([filename for filename, _ in pairs], [commit_hash for _, commit_hash in pairs]),
             )
-            await conn.commit()
+
+            return {(filename.rstrip(), commit_hash) for filename, commit_hash in await cur.fetchall()}
 
 
-async def github_files_check_exists(filename: str, commit_hash: str) -> bool:
-    async with await get_connection() as conn:
+async def github_files_find_by_content(content_sha256: str) -> str | None:
+    """Get the filename, without its CHAR padding, of the artwork with this content if it is recorded."""
+    async with get_pool().connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
                 SELECT
-                    *
+                    filename
                 FROM
                     github_files
                 WHERE
-                    filename=%s
-                    AND commit_hash=%s
+                    content_sha256=%s
                 """,
-                (filename, commit_hash),
+                (content_sha256,),
             )
-
-            rows = await cur.fetchall()
-            return len(rows) == 1
+            row = await cur.fetchone()
+            return row[0].rstrip() if row is not None else None
 
 
-async def github_files_get_all() -> list[tuple[str, str]]:
-    async with await get_connection() as conn:
+async def github_files_get_dhashes() -> list[tuple[str, str, int]]:
+    """Get the username, filename and perceptual hash of every artwork that has one."""
+    async with get_pool().connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
                 SELECT
                     github_username,
+                    filename,
+                    dhash
+                FROM
+                    github_files
+                WHERE
+                    dhash IS NOT NULL
+                """
+            )
+            return await cur.fetchall()
+
+
+async def github_files_get_missing_dhashes() -> list[tuple[int, str]]:
+    """Get the id and filename of the artworks recorded before perceptual hashes were."""
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    id,
                     filename
                 FROM
                     github_files
+                WHERE
+                    dhash IS NULL
+                ORDER BY
+                    id ASC
+                """
+            )
+            return await cur.fetchall()
+
+
+async def github_files_set_dhashes(dhashes: list[tuple[int, int]]) -> None:
+    """Set the perceptual hashes of `(id, dhash)` artworks."""
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(
+                """
+                UPDATE
+                    github_files
+                SET
+                    dhash=%s
+                WHERE
+                    id=%s
+                """,
+                [(dhash, file_id) for file_id, dhash in dhashes],
+            )
+
+
+async def github_files_get_version() -> tuple[int, int]:
+    """Get the highest id and the row count, which change whenever a row is inserted."""
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    coalesce(max(id), 0),
+                    count(*)
+                FROM
+                    github_files
+                """
+            )
+            row = await cur.fetchone()
+            assert row is not None
+            return row
+
+
+async def github_files_get_all() -> list[tuple[int, str, str, list[int]]]:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    id,
+                    github_username,
+                    filename,
+                    variants
+                FROM
+                    github_files
                 ORDER BY
                     id ASC
                 """
             )
             rows = await cur.fetchall()
             return rows
+
+
+async def github_files_get_since(since_id: int, limit: int) -> list[tuple[int, str, str, list[int]]]:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    id,
+                    github_username,
+                    filename,
+                    variants
+                FROM
+                    github_files
+                WHERE
+                    id > %s
+                ORDER BY
+                    id ASC
+                LIMIT %s
+                """,
+                (since_id, limit),
+            )
+            rows = await cur.fetchall()
+            return rows
+
+
+async def github_installations_get(account_login: str) -> int | None:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    installation_id
+                FROM
+                    github_installations
+                WHERE
+                    account_login=%s
+                """,
+                (account_login.lower(),),
+            )
+            row = await cur.fetchone()
+            return row[0] if row is not None else None
+
+
+async def github_installations_get_all() -> list[tuple[str, int]]:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    account_login,
+                    installation_id
+                FROM
+                    github_installations
+                """
+            )
+            return await cur.fetchall()
+
+
+async def github_installations_upsert(account_login: str, installation_id: int) -> None:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO github_installations (account_login, installation_id)
+                VALUES (%s, %s)
+                ON CONFLICT (account_login) DO UPDATE
+                    SET installation_id = EXCLUDED.installation_id, updated_at = now();
+                """,
+                (account_login.lower(), installation_id),
+            )
+
+
+async def github_installations_replace_all(installations: list[tuple[str, int]]) -> None:
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor() as cur:
+                await cur.execute("DELETE FROM github_installations")
+                await cur.executemany(
+                    """
+                    INSERT INTO github_installations (account_login, installation_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (account_login) DO NOTHING;
+                    """,
+                    [(account_login.lower(), installation_id) for account_login, installation_id in installations],
+                )
+
+
+async def github_installations_delete(installation_id: int) -> None:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                DELETE FROM github_installations
+                WHERE installation_id=%s;
+                """,
+                (installation_id,),
+            )
+
+
+@dataclass
+class PublishJob:
+    id: UUID
+    status: str
+    stage: str
+    attempts: int
+    github_username: str
+    installation_id: int
+    fork_name: str
+    filename: str
+    image: bytes | None
+    branch: str | None
+    commit_hash: str | None
+    # Sizes of the variants committed with the artwork, known once it is committed
+    variants: list[int] | None
+    # `None` for jobs enqueued before it was recorded
+    content_sha256: str | None
+    dhash: int | None
+    error: str | None
+
+
+async def publish_jobs_insert(
+    username: str,
+    installation_id: int,
+    fork_name: str,
+    filename: str,
+    image: bytes,
+    content_sha256: str,
+    dhash: int,
+) -> tuple[UUID, str, bool]:
+    """Insert a job, unless one with the same content is queued or running already.
+
+    Returns the id and filename of the inserted job, or else of the existing one, and whether it was inserted.
+    """
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            while True:
+                await cur.execute(
+                    """
+                    INSERT INTO publish_jobs
+                        (github_username, installation_id, fork_name, filename, image, content_sha256, dhash)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (content_sha256) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING id, filename;
+                    """,
+                    (username, installation_id, fork_name, filename, image, content_sha256, dhash),
+                )
+                row = await cur.fetchone()
+                if row is not None:
+                    return row[0], row[1], True
+
+                # A statement of its own, to see the conflicting job even if it was committed after the insert began
+                active = await _publish_jobs_find_active(cur, content_sha256)
+                # Otherwise the job finished in between, there is nothing to conflict with anymore
+                if active is not None:
+                    return active[0], active[1], False
+
+
+async def _publish_jobs_find_active(cur: AsyncCursor, content_sha256: str) -> tuple[UUID, str] | None:
+    await cur.execute(
+        """
+        SELECT
+            id,
+            filename
+        FROM
+            publish_jobs
+        WHERE
+            content_sha256=%s
+            AND status IN ('queued', 'running')
+        """,
+        (content_sha256,),
+    )
+    return await cur.fetchone()
+
+
+async def publish_jobs_find_active(content_sha256: str) -> tuple[UUID, str] | None:
+    """Get the id and filename of the queued or running job with this content, if there is one."""
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            return await _publish_jobs_find_active(cur, content_sha256)
+
+
+async def publish_jobs_find_similar(username: str, dhash: int, max_distance: int, content_sha256: str) -> str | None:
+    """Get the filename of a queued or running job of the user whose perceptual hash is within `max_distance` bits.
+
+    Jobs with the very same content are left out, publishing it again just returns that job.
+    """
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT
+                    filename
+                FROM
+                    publish_jobs
+                WHERE
+                    github_username=%s
+                    AND status IN ('queued', 'running')
+                    AND content_sha256 <> %s
+                    AND bit_count((dhash # %s)::bit(64)) <= %s
+                LIMIT 1
+                """,
+                (username, content_sha256, dhash, max_distance),
+            )
+            row = await cur.fetchone()
+            return row[0] if row is not None else None
+
+
+async def publish_jobs_claim(lock_timeout: float) -> PublishJob | None:
+    """Lock the oldest runnable job, including ones whose worker died while running them.
+
+    `SKIP LOCKED` lets any number of workers, in any number of processes, claim jobs concurrently.
+    """
+    async with get_pool().connection() as conn:
+        async with conn.cursor(row_factory=class_row(PublishJob)) as cur:
+            await cur.execute(
+                """
+                UPDATE
+                    publish_jobs
+                SET
+                    status='running',
+                    attempts=attempts + 1,
+                    locked_at=now(),
+                    updated_at=now()
+                WHERE
+                    id = (
+                        SELECT
+                            id
+                        FROM
+                            publish_jobs
+                        WHERE
+                            (status='queued' AND run_after <= now())
+                            OR (status='running' AND locked_at < now() - make_interval(secs => %s))
+                        ORDER BY
+                            created_at ASC
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                RETURNING
+                    id, status, stage, attempts, github_username, installation_id, fork_name, filename, image, branch,
+                    commit_hash, variants, content_sha256, dhash, error
+                """,
+                (lock_timeout,),
+            )
+            return await cur.fetchone()
+
+
+async def publish_jobs_get(job_id: UUID) -> PublishJob | None:
+    async with get_pool().connection() as conn:
+        async with conn.cursor(row_factory=class_row(PublishJob)) as cur:
+            await cur.execute(
+                """
+                SELECT
+                    id, status, stage, attempts, github_username, installation_id, fork_name, filename,
+                    NULL::bytea AS image, branch, commit_hash, variants, content_sha256, dhash, error
+                FROM
+                    publish_jobs
+                WHERE
+                    id=%s
+                """,
+                (job_id,),
+            )
+            return await cur.fetchone()
+
+
+async def _publish_jobs_update(job_id: UUID, assignments: str, params: tuple[object, ...] = ()) -> None:
+    async with get_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                f"""
+                UPDATE
+                    publish_jobs
+                SET
+                    {assignments},
+                    updated_at=now()
+                WHERE
+                    id=%s
+                """,  # noqa: S608
+                (*params, job_id),
+            )
+
+
+async def publish_jobs_set_stage(job_id: UUID, stage: str) -> None:
+    await _publish_jobs_update(job_id, "stage=%s", (stage,))
+
+
+async def publish_jobs_set_commit(job_id: UUID, branch: str, commit_hash: str, variants: list[int]) -> None:
+    await _publish_jobs_update(job_id, "branch=%s, commit_hash=%s, variants=%s", (branch, commit_hash, variants))
+
+
+async def publish_jobs_finish(job_id: UUID) -> None:
+    await _publish_jobs_update(job_id, "status='done', stage='done', image=NULL, error=NULL, locked_at=NULL")
+
+
+async def publish_jobs_retry(job_id: UUID, error: str, delay: float) -> None:
+    await _publish_jobs_update(
+        job_id,
+        "status='queued', error=%s, run_after=now() + make_interval(secs => %s), locked_at=NULL",
+        (error, delay),
+    )
+
+
+async def publish_jobs_fail(job_id: UUID, error: str) -> None:
+    await _publish_jobs_update(
+        job_id,
+        "status='failed', stage='failed', image=NULL, error=%s, locked_at=NULL",
+        (error,),
+    )
@@ -0,0 +1,98 @@
+import logging
+import time
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+from fastapi import HTTPException
+
+from . import forks, gh, installations, sessions, tokens
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Preflight:
+    installation_id: int
+    repository: dict[str, Any]
+
+
+async def _timed[T](timings: dict[str, float], stage: str, awaitable: Awaitable[T]) -> T:
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+async def _get_installation_id(user_name: str) -> int:
+    installation_id = await installations.get_installation_id(user_name)
+    if installation_id is None:
+        raise HTTPException(status_code=404, detail="No GitHub App installation found")
+
+    return installation_id
+
+
+async def _get_installation_token(installation_id: int) -> str:
+    try:
+        return await tokens.get_installation_token(installation_id)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+
+        # The installation is gone, but the index hasn't heard about it yet
+        await installations.remove(installation_id)
+        raise HTTPException(status_code=404, detail="No GitHub App installation found") from e
+
+
+async def _get_installation_repository(app_installation_token: str) -> dict[str, Any]:
+    installation_repositories = await gh.get_app_installation_repositories(app_installation_token)
+
+    total_repo_count = installation_repositories["total_count"]
+    if total_repo_count == 0:
+        raise HTTPException(status_code=409, detail="GitHub App not installed on any repository")
+    elif total_repo_count > 1:
+        raise HTTPException(status_code=409, detail="GitHub App must be installed on a single repository")
+
+    return installation_repositories["repositories"][0]
+
+
+async def _check_fork(repository: dict[str, Any], app_installation_token: str) -> None:
+    if not await forks.is_upstream_fork(repository, app_installation_token):
+        raise HTTPException(
+            status_code=409, detail="The installation repository must be a fork of the main repository"
+        )
+
+
+async def _run_user_stages(
+    auth_session: sessions.AuthSession,
+    timings: dict[str, float],
+) -> tuple[int, dict[str, Any]]:
+    installation_id = await _timed(timings, "installation", _get_installation_id(auth_session.user_name))
+    app_installation_token = await _timed(timings, "installation_token", _get_installation_token(installation_id))
+    repository = await _timed(timings, "repository", _get_installation_repository(app_installation_token))
+    await _timed(timings, "fork_check", _check_fork(repository, app_installation_token))
+
+    return installation_id, repository
+
+
+async def run(auth_session: sessions.AuthSession) -> Preflight:
+    """Run the GitHub pre-flight checks of an authenticated user, a chain of stages each depending on the one before.
+
+    Committing happens in the publish jobs, with tokens of their own, so only what the job needs is returned. The
+    first failing stage's exception is raised as is.
+    """
+    timings: dict[str, float] = {}
+    start = time.perf_counter()
+
+    try:
+        installation_id, repository = await _run_user_stages(auth_session, timings)
+    finally:
+        log.info(
+            "Publish pre-flight took %.1f ms (%s)",
+            (time.perf_counter() - start) * 1000,
+            ", ".join(f"{stage}={duration * 1000:.1f} ms" for stage, duration in timings.items()),
+        )
+
+    return Preflight(installation_id=installation_id, repository=repository)
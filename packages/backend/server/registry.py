@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import logging
+import math
+import sys
+from collections import Counter
+from typing import Any
+
+from . import pg
+
+log = logging.getLogger(__name__)
+
+# Up to this many published artworks are kept as an exact set, a Bloom filter is smaller past it
+EXACT_SET_MAX_SIZE = 100_000
+BLOOM_FALSE_POSITIVE_RATE = 0.001
+# Head room of a new Bloom filter, it is rebuilt bigger once it holds more than its capacity
+BLOOM_GROWTH_FACTOR = 2
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, false_positive_rate: float) -> None:
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: bytes) -> list[int]:
+        # Double hashing, the k positions are derived from two halves of one digest
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: bytes) -> None:
+        positions = self._positions(item)
+        if all(self._bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            # Most likely added already, e.g. both when recorded and when notified about it
+            return
+
+        for position in positions:
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self._bits)
+
+
+# `None` until loaded, everything might be published until then
+_items: set[bytes] | BloomFilter | None = None
+# Added while a load is running, they might not be in what it loaded
+_pending: list[bytes] | None = None
+_reload_task: asyncio.Task[None] | None = None
+_lock = asyncio.Lock()
+_metrics: Counter[str] = Counter()
+
+
+def _item(filename: str, commit_hash: str) -> bytes:
+    # Both are CHAR columns, Postgres ignores the padding when comparing them
+    return f"{filename.rstrip()}\0{commit_hash.rstrip()}".encode()
+
+
+async def load() -> None:
+    """(Re)load the registry from `github_files`, picking an exact set or a Bloom filter by the number of artworks."""
+    global _items, _pending
+
+    async with _lock:
+        _pending = []
+        try:
+            pairs = await pg.github_files_get_pairs()
+
+            items: set[bytes] | BloomFilter
+            if len(pairs) <= EXACT_SET_MAX_SIZE:
+                items = set()
+            else:
+                items = BloomFilter(len(pairs) * BLOOM_GROWTH_FACTOR, BLOOM_FALSE_POSITIVE_RATE)
+            for filename, commit_hash in pairs:
+                items.add(_item(filename, commit_hash))
+            for item in _pending:
+                items.add(item)
+
+            _items = items
+        finally:
+            _pending = None
+
+    _metrics["loads"] += 1
+    log.info("Loaded %d published artworks into the registry", len(pairs))
+
+
+def unload() -> None:
+    """Forget the loaded artworks, e.g. while artworks recorded by other processes can't be heard of."""
+    global _items
+
+    if _items is not None:
+        _metrics["unloads"] += 1
+    _items = None
+
+
+async def _reload() -> None:
+    try:
+        await load()
+    except Exception:
+        log.exception("Failed to reload the publish registry")
+
+
+def add(filename: str, commit_hash: str) -> None:
+    """Register a just recorded artwork."""
+    global _reload_task
+
+    item = _item(filename, commit_hash)
+    if _pending is not None:
+        _pending.append(item)
+    if _items is None:
+        return
+
+    _items.add(item)
+
+    # Outgrown, an exact set by size and a Bloom filter by false positive rate
+    count = len(_items) if isinstance(_items, set) else _items.count
+    limit = EXACT_SET_MAX_SIZE if isinstance(_items, set) else _items.capacity
+    if count > limit and (_reload_task is None or _reload_task.done()):
+        _reload_task = asyncio.create_task(_reload())
+
+
+def might_contain(filename: str, commit_hash: str) -> bool:
+    """`False` means the artwork is definitely not published, `True` that it probably is."""
+    if _items is None:
+        _metrics["unloaded"] += 1
+        return True
+
+    if _item(filename, commit_hash) in _items:
+        _metrics["probable_hits"] += 1
+        return True
+
+    _metrics["definite_misses"] += 1
+    return False
+
+
+def get_stats() -> dict[str, Any]:
+    if _items is None:
+        return {**_metrics, "kind": None}
+
+    if isinstance(_items, set):
+        return {
+            **_metrics,
+            "kind": "exact",
+            "items": len(_items),
+            "bytes": sys.getsizeof(_items) + sum(sys.getsizeof(item) for item in _items),
+            "false_positive_rate": 0.0,
+        }
+
+    return {
+        **_metrics,
+        "kind": "bloom",
+        "items": _items.count,
+        "capacity": _items.capacity,
+        "hash_count": _items.hash_count,
+        "bytes": _items.nbytes,
+        "false_positive_rate": _items.false_positive_rate,
+    }
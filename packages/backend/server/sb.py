@@ -1,8 +1,14 @@
+import asyncio
+from collections import Counter
+from collections.abc import AsyncIterator
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+
+import httpx
 from fastapi import HTTPException, Request, Response
+from gotrue import AsyncMemoryStorage
 from gotrue.constants import STORAGE_KEY
-from gotrue.errors import AuthSessionMissingError
 from gotrue.types import UserIdentity
-from supabase import AsyncClient, AsyncClientOptions, create_async_client
+from supabase import AsyncClient, AsyncClientOptions
 
 from . import env
 
@@ -10,6 +16,11 @@ ACCESS_TOKEN_COOKIE_KEY = "sb_access_token"  # noqa: S105
 REFRESH_TOKEN_COOKIE_KEY = "sb_refresh_token"  # noqa: S105
 CODE_VERIFIER_COOKIE_KEY = "sb_code_verifier"
 
+_http_client: httpx.AsyncClient | None = None
+_internal_clients: asyncio.LifoQueue[AsyncClient] | None = None
+_public_clients: asyncio.LifoQueue[AsyncClient] | None = None
+_metrics: Counter[str] = Counter()
+
 
 def set_response_token_cookies_(response: Response, access_token: str, refresh_token: str) -> None:
     response.set_cookie(
@@ -28,22 +39,103 @@ def set_response_token_cookies_(response: Response, access_token: str, refresh_t
     )
 
 
-async def create_internal_client() -> AsyncClient:
-    """Create a Supabase client."""
-    return await create_async_client(
-        supabase_url=env.SUPABASE_INTERNAL_URL,
+def _create_client(supabase_url: str, http_client: httpx.AsyncClient) -> AsyncClient:
+    return AsyncClient(
+        supabase_url=supabase_url,
         supabase_key=env.SUPABASE_KEY,
-        options=AsyncClientOptions(flow_type="pkce"),
+        options=AsyncClientOptions(
+            flow_type="pkce",
+            # Sessions only live for a single checkout, there is nothing to refresh in the background
+            auto_refresh_token=False,
+            storage=AsyncMemoryStorage(),
+            httpx_client=http_client,
+        ),
     )
 
 
-async def create_public_client() -> AsyncClient:
-    """Create a Supabase client."""
-    return await create_async_client(
-        supabase_url=env.SUPABASE_PUBLIC_URL,
-        supabase_key=env.SUPABASE_KEY,
-        options=AsyncClientOptions(flow_type="pkce"),
+async def _reset_client(client: AsyncClient) -> None:
+    """Forget everything a checkout left behind, so the next user doesn't get the previous one's session.
+
+    `sign_out` would also revoke the session on the server, the user's cookies still hold it. So this undoes what
+    signing in changes: the auth client's session and storage (with the PKCE code verifier), and what the client's
+    auth listener sets from them, the `Authorization` header, the clients built with it and the realtime token.
+    """
+    try:
+        # The auth listener sets the realtime token in a task of its own, it has to run before the token is reset
+        await asyncio.sleep(0)
+    finally:
+        client.auth._storage = AsyncMemoryStorage()  # noqa: SLF001
+        client.auth._in_memory_session = None  # noqa: SLF001
+        client.options.headers["Authorization"] = client._create_auth_header(env.SUPABASE_KEY)  # noqa: SLF001
+        client._postgrest = None  # noqa: SLF001
+        client._storage = None  # noqa: SLF001
+        client._functions = None  # noqa: SLF001
+        # No channels are ever joined, so this doesn't send anything
+        await client.realtime.set_auth(env.SUPABASE_KEY)
+
+
+async def open_clients() -> None:
+    """Create the Supabase client pools, all clients share one keep-alive HTTP client."""
+    global _http_client, _internal_clients, _public_clients
+
+    _http_client = httpx.AsyncClient(
+        follow_redirects=True,
+        http2=True,
+        limits=httpx.Limits(max_connections=env.SUPABASE_CLIENT_POOL_SIZE * 2),
     )
+    _internal_clients = asyncio.LifoQueue()
+    _public_clients = asyncio.LifoQueue()
+    for _ in range(env.SUPABASE_CLIENT_POOL_SIZE):
+        _internal_clients.put_nowait(_create_client(env.SUPABASE_INTERNAL_URL, _http_client))
+        _public_clients.put_nowait(_create_client(env.SUPABASE_PUBLIC_URL, _http_client))
+
+
+async def close_clients() -> None:
+    global _http_client, _internal_clients, _public_clients
+
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _internal_clients = None
+    _public_clients = None
+
+
+@asynccontextmanager
+async def _checkout(clients: asyncio.LifoQueue[AsyncClient] | None) -> AsyncIterator[AsyncClient]:
+    if clients is None:
+        msg = "Supabase clients are not open."
+        raise RuntimeError(msg)
+
+    _metrics["checkouts"] += 1
+    if clients.empty():
+        _metrics["checkout_waits"] += 1
+
+    client = await clients.get()
+    try:
+        yield client
+    finally:
+        try:
+            await _reset_client(client)
+        finally:
+            clients.put_nowait(client)
+
+
+def internal_client() -> AbstractAsyncContextManager[AsyncClient]:
+    """Check out a pooled Supabase client talking to `SUPABASE_INTERNAL_URL`."""
+    return _checkout(_internal_clients)
+
+
+def public_client() -> AbstractAsyncContextManager[AsyncClient]:
+    """Check out a pooled Supabase client for URLs handed to the browser."""
+    return _checkout(_public_clients)
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "internal_clients_idle": _internal_clients.qsize() if _internal_clients is not None else 0,
+        "public_clients_idle": _public_clients.qsize() if _public_clients is not None else 0,
+    }
 
 
 async def get_code_verifier_from_client(client: AsyncClient) -> str:
@@ -57,26 +149,22 @@ async def get_code_verifier_from_client(client: AsyncClient) -> str:
     return code_verifier
 
 
-async def get_session(request: Request) -> AsyncClient:
-    """Get a Supabase client session."""
+@asynccontextmanager
+async def get_session(request: Request) -> AsyncIterator[AsyncClient]:
+    """Check out a Supabase client holding the request's session."""
     access_token = request.cookies.get(ACCESS_TOKEN_COOKIE_KEY)
     refresh_token = request.cookies.get(REFRESH_TOKEN_COOKIE_KEY)
 
     if access_token is None or refresh_token is None:
         raise HTTPException(status_code=401, detail="No session tokens found")
 
-    client = await create_internal_client()
-    await client.auth.set_session(access_token=access_token, refresh_token=refresh_token)
-
-    return client
-
+    async with internal_client() as client:
+        await client.auth.set_session(access_token=access_token, refresh_token=refresh_token)
+        yield client
 
-async def get_github_identity(client: AsyncClient) -> UserIdentity:
-    user_identities = await client.auth.get_user_identities()
-    if isinstance(user_identities, AuthSessionMissingError):
-        raise HTTPException(status_code=401, detail="User not authenticated")
 
-    for identity in user_identities.identities:
+def find_github_identity(identities: list[UserIdentity]) -> UserIdentity:
+    for identity in identities:
         if identity.provider == "github":
             gh_identity = identity
             break
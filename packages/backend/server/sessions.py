@@ -0,0 +1,140 @@
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+
+import jwt
+from fastapi import HTTPException, Request
+from gotrue.errors import AuthError
+
+from . import env, sb
+
+# Same as gotrue's, tokens this close to expiring are refreshed
+EXPIRY_MARGIN = 10
+IDENTITY_CACHE_TTL = 10 * 60
+IDENTITY_CACHE_MAX_SIZE = 10_000
+
+# Supabase user id -> (GitHub user name, cached at), least recently used first
+_user_names: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_metrics: Counter[str] = Counter()
+
+
+@dataclass
+class AuthSession:
+    user_id: str
+    user_name: str
+    access_token: str
+    refresh_token: str
+
+
+def _decode_access_token(access_token: str) -> dict[str, object] | None:
+    """Verify a Supabase access token in-process, `None` means it has to be refreshed."""
+    try:
+        claims = jwt.decode(
+            access_token,
+            env.JWT_SECRET,
+            algorithms=["HS256"],
+            audience="authenticated",
+            options={"require": ["exp", "sub"]},
+        )
+    except jwt.ExpiredSignatureError:
+        return None
+    except jwt.InvalidTokenError as e:
+        raise HTTPException(status_code=401, detail="Invalid access token") from e
+
+    if claims["exp"] - time.time() <= EXPIRY_MARGIN:
+        return None
+
+    return claims
+
+
+def _cache_user_name(user_id: str, user_name: str) -> None:
+    _user_names[user_id] = (user_name, time.time())
+    _user_names.move_to_end(user_id)
+    while len(_user_names) > IDENTITY_CACHE_MAX_SIZE:
+        _user_names.popitem(last=False)
+
+
+def _get_cached_user_name(user_id: str) -> str | None:
+    cached = _user_names.get(user_id)
+    if cached is None or time.time() - cached[1] > IDENTITY_CACHE_TTL:
+        return None
+
+    _user_names.move_to_end(user_id)
+    return cached[0]
+
+
+async def _fetch_user_name(access_token: str) -> str:
+    async with sb.internal_client() as client:
+        try:
+            response = await client.auth.get_user(access_token)
+        except AuthError as e:
+            raise HTTPException(status_code=401, detail="User not authenticated") from e
+
+    if response is None or response.user.identities is None:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+
+    return sb.find_github_identity(response.user.identities).identity_data["user_name"]
+
+
+async def _refresh(request: Request) -> AuthSession:
+    _metrics["refreshed"] += 1
+    async with sb.get_session(request) as client:
+        client_session = await client.auth.get_session()
+
+    if client_session is None:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+
+    user_name = sb.find_github_identity(client_session.user.identities or []).identity_data["user_name"]
+    _cache_user_name(client_session.user.id, user_name)
+
+    return AuthSession(
+        user_id=client_session.user.id,
+        user_name=user_name,
+        access_token=client_session.access_token,
+        refresh_token=client_session.refresh_token,
+    )
+
+
+async def authenticate(request: Request) -> AuthSession:
+    """Authenticate a request by its session cookies.
+
+    The access token is verified locally against `JWT_SECRET` and the GitHub user name comes from a TTL cache of
+    identities, so the common case needs no network round trips. gotrue is only asked for the identities on a cache
+    miss and for a new session when the access token is about to expire. The user name isn't taken from the token's
+    `user_metadata` claim since users can edit that themselves.
+
+    Signed out sessions stay valid here until their access token expires.
+    """
+    access_token = request.cookies.get(sb.ACCESS_TOKEN_COOKIE_KEY)
+    refresh_token = request.cookies.get(sb.REFRESH_TOKEN_COOKIE_KEY)
+
+    if access_token is None or refresh_token is None:
+        raise HTTPException(status_code=401, detail="No session tokens found")
+
+    claims = _decode_access_token(access_token)
+    if claims is None:
+        return await _refresh(request)
+
+    _metrics["verified_locally"] += 1
+    user_id = str(claims["sub"])
+    user_name = _get_cached_user_name(user_id)
+    if user_name is not None:
+        _metrics["identity_cache_hits"] += 1
+    else:
+        _metrics["identity_cache_misses"] += 1
+        user_name = await _fetch_user_name(access_token)
+        _cache_user_name(user_id, user_name)
+
+    return AuthSession(
+        user_id=user_id,
+        user_name=user_name,
+        access_token=access_token,
+        refresh_token=refresh_token,
+    )
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "identities_cached": len(_user_names),
+    }
@@ -0,0 +1,104 @@
+"""Sign published artworks, so the data branch workflow can tell the backend's PRs apart without calling it.
+
+The signature is an HMAC of the path and git blob sha of every file in the commit (the artwork and its smaller
+variants) with `PUBLISH_HMAC_SECRET`, added to the commit message as a `Publish-Signature` trailer. The blob sha is
+the same one git computes, so the workflow can check the signature against the PR's actual content with nothing more
+than git and the secret.
+
+Only needs the standard library, so the workflow runs it as a plain script, e.g.
+
+    PUBLISH_HMAC_SECRET=... python signing.py verify-commit <commit hash>
+
+which exits with 0 if the commit's files are signed by the backend, and 1 if they aren't (or the signature is
+missing).
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import subprocess
+import sys
+
+TRAILER = "Publish-Signature"
+PREFIX = "sha256="
+
+
+def git_blob_sha(content: bytes) -> str:
+    """Get the sha git gives a file with this content, i.e. `git hash-object`."""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()  # noqa: S324
+
+
+def sign(secret: str, files: dict[str, str]) -> str:
+    """Sign the files (path -> blob sha) of a commit, in any order."""
+    message = "\n".join(f"{path}\n{blob_sha}" for path, blob_sha in sorted(files.items())).encode()
+    return PREFIX + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify(secret: str, files: dict[str, str], signature: str) -> bool:
+    return hmac.compare_digest(sign(secret, files), signature.strip())
+
+
+def add_trailer(message: str, signature: str) -> str:
+    return f"{message}\n\n{TRAILER}: {signature}"
+
+
+def _git(*args: str) -> str:
+    return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout.strip()  # noqa: S603, S607
+
+
+def get_commit_files(commit_hash: str) -> dict[str, str]:
+    """Get the files a (locally available) commit adds or changes, path -> blob sha."""
+    files = {}
+    # One `:<old mode> <new mode> <old sha> <new sha> <status>\t<path>` line per file
+    for line in _git("diff-tree", "-r", "--no-commit-id", "--no-renames", commit_hash).splitlines():
+        meta, path = line.split("\t", 1)
+        files[path] = meta.split()[3]
+    return files
+
+
+def verify_commit(secret: str, commit_hash: str) -> bool:
+    """Check the signature in the message of a (locally available) commit against the files it contains."""
+    signature = _git("show", "-s", f"--format=%(trailers:key={TRAILER},valueonly,separator=%x2C)", commit_hash)
+    if not signature:
+        return False
+
+    return verify(secret, get_commit_files(commit_hash), signature)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sign_parser = subparsers.add_parser("sign", help="print the signature of files committed together")
+    sign_parser.add_argument("paths", nargs="+", help="files to sign, signed under these paths")
+
+    verify_parser = subparsers.add_parser("verify-commit", help="check the signature of a commit")
+    verify_parser.add_argument("commit_hash")
+
+    args = parser.parse_args(argv)
+
+    secret = os.getenv("PUBLISH_HMAC_SECRET")
+    if not secret:
+        parser.error("PUBLISH_HMAC_SECRET is not set")
+
+    if args.command == "sign":
+        files = {}
+        for path in args.paths:
+            with open(path, "rb") as f:  # noqa: PTH123
+                files[path] = git_blob_sha(f.read())
+        print(sign(secret, files))
+        return
+
+    try:
+        is_valid = verify_commit(secret, args.commit_hash)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr, file=sys.stderr)
+        is_valid = False
+
+    print("valid" if is_valid else "invalid")
+    sys.exit(0 if is_valid else 1)
+
+
+if __name__ == "__main__":
+    main()
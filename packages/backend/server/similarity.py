@@ -0,0 +1,243 @@
+"""Perceptual hash index of the published artworks, for near-duplicates and `/artworks/{filename}/similar`.
+
+Artworks recorded before there were perceptual hashes get theirs from the data branch with
+
+    uv run --env-file .env python -m server.similarity
+
+which running backends pick up the next time they load the index, e.g. when restarted.
+"""
+
+import asyncio
+import io
+import itertools
+import logging
+import math
+from collections import Counter
+from typing import Any
+
+import httpx
+from PIL import Image
+
+from . import env, images, pg
+
+log = logging.getLogger(__name__)
+
+# The most bits `/artworks/{filename}/similar` can be asked for, the index is about as slow as a linear scan by 16
+MAX_DISTANCE = 12
+DEFAULT_DISTANCE = 8
+MAX_RESULTS = 100
+# Fewer bits set than this, the artwork is mostly blank canvas, and any two sparse doodles are a few bits apart
+MIN_BITS = 8
+
+# Artworks downloaded at once while backfilling
+BACKFILL_CONCURRENCY = 8
+
+# Hashes are stored signed, like Postgres' BIGINT, and compared as their unsigned 64 bits
+_MASK = (1 << 64) - 1
+# The index splits hashes into this many chunks
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+# Every chunk value, fewest bits first, the ones within `r` bits of 0 are the first `_WITHIN[r]`
+_CHUNK_MASKS = sorted(range(1 << CHUNK_BITS), key=int.bit_count)
+_WITHIN = list(itertools.accumulate(math.comb(CHUNK_BITS, bits) for bits in range(CHUNK_BITS + 1)))
+
+
+class HammingIndex:
+    """Multi-index hashing of 64-bit hashes, finding the ones within a Hamming distance of a query.
+
+    Every hash is split into `CHUNKS` chunks, each indexed in a table of its own. Two hashes within `k` bits of each
+    other have at least one chunk within `k // CHUNKS` bits of each other (the pigeonhole principle), so a query only
+    looks up the chunk values that close in each table and checks the full distance of the hashes it finds there.
+    """
+
+    def __init__(self) -> None:
+        # Hash -> items, artworks that look the same share their hash
+        self._items: dict[int, list[Any]] = {}
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(CHUNKS)]
+        self.count = 0
+        # Hashes compared by `find`, over all queries
+        self.candidates = 0
+
+    @classmethod
+    def build(cls, items: list[tuple[int, Any]]) -> "HammingIndex":
+        index = cls()
+        for value, item in items:
+            index.add(value, item)
+        return index
+
+    @staticmethod
+    def _chunks(value: int) -> list[int]:
+        return [value >> (i * CHUNK_BITS) & ((1 << CHUNK_BITS) - 1) for i in range(CHUNKS)]
+
+    def add(self, value: int, item: Any) -> None:
+        value &= _MASK
+        self.count += 1
+        items = self._items.get(value)
+        if items is not None:
+            items.append(item)
+            return
+
+        self._items[value] = [item]
+        for table, chunk in zip(self._tables, self._chunks(value), strict=True):
+            table.setdefault(chunk, []).append(value)
+
+    def find(self, value: int, max_distance: int) -> list[tuple[Any, int]]:
+        """Get the items whose hash is within `max_distance` bits of `value`, with their distance."""
+        value &= _MASK
+        masks = _CHUNK_MASKS[: _WITHIN[max_distance // CHUNKS]]
+
+        seen: set[int] = set()
+        results: list[tuple[Any, int]] = []
+        for table, chunk in zip(self._tables, self._chunks(value), strict=True):
+            for mask in masks:
+                for candidate in table.get(chunk ^ mask, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+
+                    distance = (candidate ^ value).bit_count()
+                    if distance <= max_distance:
+                        results.extend((item, distance) for item in self._items[candidate])
+
+        self.candidates += len(seen)
+        return results
+
+    @property
+    def hashes(self) -> int:
+        return len(self._items)
+
+
+# `None` until loaded
+_index: HammingIndex | None = None
+# Filename (without the CHAR padding) -> hash, to look up the artwork a similarity query starts from
+_hashes: dict[str, int] = {}
+# Added while a load is running, they might not be in what it loaded
+_pending: list[tuple[str, str, int]] | None = None
+_lock = asyncio.Lock()
+_metrics: Counter[str] = Counter()
+
+
+async def load() -> None:
+    """(Re)build the index from the perceptual hashes in `github_files`, in one go."""
+    global _index, _hashes, _pending
+
+    async with _lock:
+        _pending = []
+        try:
+            rows = await pg.github_files_get_dhashes()
+            rows.extend(_pending)
+
+            _index = HammingIndex.build([(dhash, (username, filename.rstrip())) for username, filename, dhash in rows])
+            _hashes = {filename.rstrip(): dhash for _, filename, dhash in rows}
+        finally:
+            _pending = None
+
+    _metrics["loads"] += 1
+    log.info("Loaded %d perceptual hashes into the similarity index", _index.count)
+
+
+def add(username: str, filename: str, dhash: int | None) -> None:
+    """Index a just recorded artwork, if it has a perceptual hash."""
+    if dhash is None:
+        return
+
+    if _pending is not None:
+        _pending.append((username, filename, dhash))
+    if _index is None or filename.rstrip() in _hashes:
+        return
+
+    _index.add(dhash, (username, filename.rstrip()))
+    _hashes[filename.rstrip()] = dhash
+
+
+def is_distinctive(dhash: int) -> bool:
+    """Whether the hash tells an artwork apart from the others enough for a near-duplicate check."""
+    return (dhash & _MASK).bit_count() >= MIN_BITS
+
+
+def is_loaded() -> bool:
+    return _index is not None
+
+
+def get_hash(filename: str) -> int | None:
+    return _hashes.get(filename.rstrip())
+
+
+def find(dhash: int, max_distance: int) -> list[tuple[str, str, int]]:
+    """Get the `(username, filename, distance)` of the artworks within `max_distance` bits, closest first."""
+    if _index is None:
+        return []
+
+    _metrics["queries"] += 1
+    results = [(username, filename, distance) for (username, filename), distance in _index.find(dhash, max_distance)]
+    return sorted(results, key=lambda result: result[2])
+
+
+def find_by_user(username: str, dhash: int, max_distance: int) -> str | None:
+    """Get the filename of an artwork of the user within `max_distance` bits, if there is one."""
+    for artwork_username, filename, _ in find(dhash, max_distance):
+        # GitHub usernames are case-insensitive
+        if artwork_username.lower() == username.lower():
+            return filename
+    return None
+
+
+def get_stats() -> dict[str, Any]:
+    if _index is None:
+        return {**_metrics, "loaded": False}
+
+    return {
+        **_metrics,
+        "loaded": True,
+        "items": _index.count,
+        "hashes": _index.hashes,
+        "candidates_per_query": round(_index.candidates / _metrics["queries"]) if _metrics["queries"] else 0,
+    }
+
+
+def _hash_image(data: bytes) -> int:
+    with Image.open(io.BytesIO(data), formats=images.ACCEPTED_FORMATS) as image:
+        return images.dhash(image)
+
+
+async def backfill() -> int:
+    """Hash the artworks that don't have a perceptual hash yet, downloading them from the data branch."""
+    missing = await pg.github_files_get_missing_dhashes()
+    base_url = (
+        f"https://raw.githubusercontent.com/{env.GIT_UPSTREAM_OWNER}/{env.GIT_UPSTREAM_REPO}/"
+        f"{env.GIT_UPSTREAM_DATA_BRANCH}/"
+    )
+
+    hashed = 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+
+        async def hash_artwork(file_id: int, filename: str) -> tuple[int, int] | None:
+            try:
+                r = await client.get(filename.rstrip())
+                r.raise_for_status()
+                return file_id, await asyncio.to_thread(_hash_image, r.content)
+            except Exception:
+                log.exception("Failed to hash %s", filename.rstrip())
+                return None
+
+        for i in range(0, len(missing), BACKFILL_CONCURRENCY):
+            results = await asyncio.gather(*(hash_artwork(*row) for row in missing[i : i + BACKFILL_CONCURRENCY]))
+            dhashes = [result for result in results if result is not None]
+            await pg.github_files_set_dhashes(dhashes)
+            hashed += len(dhashes)
+
+    log.info("Hashed %d of %d artworks without a perceptual hash", hashed, len(missing))
+    return hashed
+
+
+async def _main() -> None:
+    await pg.open_pool()
+    try:
+        await backfill()
+    finally:
+        await pg.close_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+import time
+from collections import Counter
+from datetime import datetime
+
+import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from . import env, gh
+
+APP_TOKEN_LIFETIME = 9 * 60  # GitHub caps App JWTs at 10 minutes
+APP_TOKEN_CLOCK_DRIFT = 60  # Backdate `iat` as recommended by GitHub
+APP_TOKEN_REFRESH_MARGIN = 60
+
+# Installation tokens live for an hour, hand out only ones that outlive a whole publish
+INSTALLATION_TOKEN_MIN_TTL = 5 * 60
+INSTALLATION_TOKEN_REFRESH_MARGIN = 10 * 60
+INSTALLATION_TOKEN_IDLE_TIMEOUT = 60 * 60
+REFRESH_INTERVAL = 60
+
+_private_key = load_pem_private_key(env.PRIVATE_KEY.encode(), password=None)
+
+_app_token: tuple[str, float] | None = None
+# installation id -> (token, expires at, last used at)
+_installation_tokens: dict[int, tuple[str, float, float]] = {}
+_inflight: dict[int, asyncio.Task[tuple[str, float]]] = {}
+_refresher: asyncio.Task[None] | None = None
+_metrics: Counter[str] = Counter()
+
+
+def get_app_token() -> str:
+    """Get a JWT for the GitHub App, signing a new one only shortly before the cached one expires."""
+    global _app_token
+
+    now = time.time()
+    if _app_token is not None and _app_token[1] - now > APP_TOKEN_REFRESH_MARGIN:
+        return _app_token[0]
+
+    issued_at = int(now) - APP_TOKEN_CLOCK_DRIFT
+    expires_at = int(now) + APP_TOKEN_LIFETIME
+    payload = {
+        "iat": issued_at,
+        "exp": expires_at,
+        "iss": env.CLIENT_ID,  # GitHub App ID
+    }
+    token = jwt.encode(payload, _private_key, algorithm="RS256")
+    _app_token = (token, expires_at)
+    _metrics["app_tokens_signed"] += 1
+
+    return token
+
+
+async def _mint_installation_token(installation_id: int) -> tuple[str, float]:
+    data = await gh.create_app_installation_token(installation_id, get_app_token())
+    expires_at = datetime.fromisoformat(data["expires_at"]).timestamp()
+    _metrics["installation_tokens_minted"] += 1
+
+    return data["token"], expires_at
+
+
+async def _refresh_installation_token(installation_id: int) -> tuple[str, float]:
+    """Mint a new installation token, concurrent callers for the same installation share one request."""
+    task = _inflight.get(installation_id)
+    if task is None:
+        task = asyncio.create_task(_mint_installation_token(installation_id))
+        _inflight[installation_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(installation_id, None))
+
+    token, expires_at = await asyncio.shield(task)
+    previous = _installation_tokens.get(installation_id)
+    last_used_at = previous[2] if previous is not None else time.time()
+    _installation_tokens[installation_id] = (token, expires_at, last_used_at)
+
+    return token, expires_at
+
+
+async def get_installation_token(installation_id: int) -> str:
+    """Get an installation token for the GitHub App, minting one only if the cached token is about to expire.
+
+    This token is used to perform actions on behalf of the installation.
+    """
+    now = time.time()
+    cached = _installation_tokens.get(installation_id)
+    if cached is not None and cached[1] - now > INSTALLATION_TOKEN_MIN_TTL:
+        _metrics["installation_token_hits"] += 1
+        token = cached[0]
+    else:
+        _metrics["installation_token_misses"] += 1
+        token, _ = await _refresh_installation_token(installation_id)
+
+    _installation_tokens[installation_id] = (*_installation_tokens[installation_id][:2], now)
+
+    return token
+
+
+def invalidate_installation_token(installation_id: int) -> None:
+    _installation_tokens.pop(installation_id, None)
+
+
+async def _refresh_loop() -> None:
+    """Refresh recently used installation tokens before they expire, forget idle ones."""
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+        now = time.time()
+        for installation_id, (_, expires_at, last_used_at) in list(_installation_tokens.items()):
+            if now - last_used_at > INSTALLATION_TOKEN_IDLE_TIMEOUT:
+                invalidate_installation_token(installation_id)
+            elif expires_at - now < INSTALLATION_TOKEN_REFRESH_MARGIN:
+                try:
+                    await _refresh_installation_token(installation_id)
+                except Exception:  # noqa: BLE001
+                    # Dropping it makes the next request mint the token and surface the error itself
+                    invalidate_installation_token(installation_id)
+
+
+def start_refresher() -> None:
+    global _refresher
+
+    _refresher = asyncio.create_task(_refresh_loop())
+
+
+async def stop_refresher() -> None:
+    global _refresher
+
+    if _refresher is not None:
+        _refresher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _refresher
+        _refresher = None
+
+
+def get_stats() -> dict[str, int]:
+    return {
+        **_metrics,
+        "installation_tokens_cached": len(_installation_tokens),
+    }
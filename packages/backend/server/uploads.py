@@ -0,0 +1,170 @@
+import io
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import IO
+
+from fastapi import HTTPException, Request
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from . import env
+
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 16 * 1024
+
+_metrics: Counter[str] = Counter()
+
+
+@dataclass
+class Upload:
+    # In memory, or a named temporary file once larger than `PUBLISH_UPLOAD_SPOOL_SIZE`
+    file: IO[bytes]
+    size: int
+
+    @property
+    def spooled_to_disk(self) -> bool:
+        return not isinstance(self.file, io.BytesIO)
+
+    def source(self) -> bytes | Path:
+        """The upload for the image workers, one on disk is opened by them rather than read back into memory here."""
+        if isinstance(self.file, io.BytesIO):
+            return self.file.getvalue()
+
+        self.file.flush()
+        return Path(self.file.name)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def _too_large() -> HTTPException:
+    _metrics["rejected_too_large"] += 1
+    return HTTPException(status_code=413, detail=f"Uploads are limited to {env.PUBLISH_MAX_UPLOAD_SIZE} bytes")
+
+
+def check_content_length(request: Request) -> None:
+    """Reject an upload that announces being too large, before anything else is done with the request."""
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        # Chunked, the limit is enforced while it is streamed instead
+        return
+
+    try:
+        size = int(content_length)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length") from e
+
+    if size > env.PUBLISH_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+        raise _too_large()
+
+
+class _FileFieldParser:
+    """Callbacks of a multipart parser, keeping only the content of the file part named `field_name`."""
+
+    def __init__(self, field_name: str) -> None:
+        self.field_name = field_name.encode()
+        self.file: IO[bytes] | None = None
+        self.size = 0
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._in_field = False
+
+    def on_part_begin(self) -> None:
+        self._disposition = b""
+        self._in_field = False
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        # Only the first one, a repeated field is ignored like any other
+        self._in_field = options.get(b"name") == self.field_name and b"filename" in options and self.file is None
+        if self._in_field:
+            self.file = io.BytesIO()
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self._in_field:
+            return
+
+        assert self.file is not None
+        self.size += end - start
+        if self.size > env.PUBLISH_MAX_UPLOAD_SIZE:
+            raise _too_large()
+
+        if self.size > env.PUBLISH_UPLOAD_SPOOL_SIZE and isinstance(self.file, io.BytesIO):
+            # Named, so that an image worker process can open it by its path
+            spooled = NamedTemporaryFile(prefix="upload-", suffix=".tmp")  # noqa: SIM115
+            spooled.write(self.file.getbuffer())
+            self.file.close()
+            self.file = spooled
+        self.file.write(data[start:end])
+
+    def on_part_end(self) -> None:
+        self._in_field = False
+
+
+async def ingest(request: Request, field_name: str = "image") -> Upload:
+    """Stream the file of a `multipart/form-data` request into memory, or a temporary file when it is large.
+
+    The file stays in memory up to `PUBLISH_UPLOAD_SPOOL_SIZE` bytes and goes to disk past it. The request is rejected
+    with 413 as soon as it is larger than `PUBLISH_MAX_UPLOAD_SIZE`, without reading the rest of it.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=415, detail="Expected multipart/form-data")
+
+    fields = _FileFieldParser(field_name)
+    parser = MultipartParser(
+        params[b"boundary"],
+        {
+            "on_part_begin": fields.on_part_begin,
+            "on_part_data": fields.on_part_data,
+            "on_part_end": fields.on_part_end,
+            "on_header_field": fields.on_header_field,
+            "on_header_value": fields.on_header_value,
+            "on_header_end": fields.on_header_end,
+            "on_headers_finished": fields.on_headers_finished,
+        },
+    )
+
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > env.PUBLISH_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+                raise _too_large()
+            parser.write(chunk)
+        parser.finalize()
+    except Exception as e:
+        if fields.file is not None:
+            fields.file.close()
+        if isinstance(e, MultipartParseError):
+            raise HTTPException(status_code=400, detail="Invalid multipart body") from e
+        raise
+
+    if fields.file is None:
+        raise HTTPException(status_code=422, detail=f"Missing file field '{field_name}'")
+
+    _metrics["accepted"] += 1
+    _metrics["bytes"] += fields.size
+    upload = Upload(file=fields.file, size=fields.size)
+    _metrics["spooled_to_disk"] += upload.spooled_to_disk
+
+    return upload
+
+
+def get_stats() -> dict[str, int]:
+    return dict(_metrics)
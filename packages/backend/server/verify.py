@@ -0,0 +1,80 @@
+import time
+from collections import Counter, OrderedDict
+
+from . import pg, registry
+
+MAX_BATCH_SIZE = 100
+# Published artworks stay published, so a positive answer can be kept around for long
+POSITIVE_CACHE_TTL = 10 * 60
+# Only reached for the registry's false positives, or while it is loading, so these are kept briefly
+NEGATIVE_CACHE_TTL = 10
+CACHE_MAX_SIZE = 10_000
+
+# (filename, commit hash) -> (is valid, cached at), least recently used first
+_results: OrderedDict[tuple[str, str], tuple[bool, float]] = OrderedDict()
+_metrics: Counter[str] = Counter()
+
+
+def _key(filename: str, commit_hash: str) -> tuple[str, str]:
+    # Both are CHAR columns, Postgres ignores the padding when comparing them
+    return filename.rstrip(), commit_hash.rstrip()
+
+
+def _cache(key: tuple[str, str], is_valid: bool) -> None:
+    _results[key] = (is_valid, time.time())
+    _results.move_to_end(key)
+    while len(_results) > CACHE_MAX_SIZE:
+        _results.popitem(last=False)
+
+
+def _get_cached(key: tuple[str, str]) -> bool | None:
+    cached = _results.get(key)
+    if cached is None:
+        return None
+
+    is_valid, cached_at = cached
+    if time.time() - cached_at > (POSITIVE_CACHE_TTL if is_valid else NEGATIVE_CACHE_TTL):
+        return None
+
+    _results.move_to_end(key)
+    return is_valid
+
+
+def remember(filename: str, commit_hash: str) -> None:
+    """Mark a just recorded artwork as valid, replacing a negative answer cached before it was recorded."""
+    _cache(_key(filename, commit_hash), True)
+
+
+async def verify_many(prs: list[tuple[str, str]]) -> list[bool]:
+    """Check which `(filename, commit hash)` pairs were published by the backend.
+
+    Pairs the registry doesn't know are answered right away, the rest from the cache or else with a single query.
+    """
+    keys = [_key(filename, commit_hash) for filename, commit_hash in prs]
+
+    results: dict[tuple[str, str], bool] = {}
+    for key in keys:
+        if not registry.might_contain(*key):
+            results[key] = False
+            continue
+
+        cached = _get_cached(key)
+        if cached is not None:
+            _metrics["hits"] += 1
+            results[key] = cached
+
+    missing = list(dict.fromkeys(key for key in keys if key not in results))
+    _metrics["misses"] += len(missing)
+
+    if missing:
+        found = await pg.github_files_find_existing(missing)
+        _metrics["queries"] += 1
+        for key in missing:
+            results[key] = key in found
+            _cache(key, results[key])
+
+    return [results[key] for key in keys]
+
+
+def get_stats() -> dict[str, int]:
+    return {**_metrics, "cached": len(_results)}
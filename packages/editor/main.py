@@ -8,6 +8,8 @@ from nicegui.client import Client
 from nicegui.events import UploadEventArguments, ValueChangeEventArguments
 
 SPIN_COUNT = 10
+# Seconds to wait for an artwork to be published
+PUBLISH_TIMEOUT = 300
 
 HEX = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "A", "B", "C", "D", "E", "F"]
 
@@ -271,8 +273,10 @@ async def index(client: Client) -> None:  # noqa: C901, PLR0915 All of the below
         """Fetch the API and publish the canvas."""
         ui.notify("Publishing...")
         try:
-            response_ok = await ui.run_javascript(
-                """
+            result = await ui.run_javascript(
+                # Give up polling a bit before Python stops waiting, so the user is told why
+                f"const deadline = Date.now() + {(PUBLISH_TIMEOUT - 10) * 1000};"
+                + """
                 const format = "image/webp";
                 const quality = 0.7;  // 70%
 
@@ -280,7 +284,7 @@ async def index(client: Client) -> None:  # noqa: C901, PLR0915 All of the below
                 const blob = await new Promise((r) => canvas.toBlob(r, format, quality));
 
                 if (blob === null) {
-                    return false;
+                    return "failed";
                 }
 
                 // Use FormData so FastAPI can read it as UploadFile
@@ -295,12 +299,57 @@ async def index(client: Client) -> None:  # noqa: C901, PLR0915 All of the below
                     },
                 ).catch((e) => console.error(e));
 
-                return response.ok;
+                if (!response?.ok) {
+                    const error = await response?.json().catch(() => null);
+                    if (error?.detail?.code === "near_duplicate") {
+                        // Almost the same as another artwork of the user
+                        return "similar";
+                    }
+                    // Such as the GitHub App not being installed on the user's fork
+                    return typeof error?.detail === "string" ? `failed: ${error.detail}` : "failed";
+                }
+
+                // The backend publishes in the background, poll the job until it's through
+                const { job_id } = await response.json();
+                if (job_id === null) {
+                    // The same artwork is published already
+                    return "duplicate";
+                }
+                while (Date.now() < deadline) {
+                    await new Promise((r) => setTimeout(r, 2000));
+
+                    const poll = await fetch(`/api/publish/${job_id}`).catch((e) => console.error(e));
+                    if (!poll?.ok) {
+                        // Such as the job being gone, polling it again won't bring it back
+                        return "failed";
+                    }
+                    const job = await poll.json().catch(() => null);
+
+                    if (job?.status === "done") {
+                        return "published";
+                    }
+                    if (!job?.status || job.status === "failed") {
+                        return "failed";
+                    }
+                }
+                return "timeout";
                 """,
-                timeout=300,
+                timeout=PUBLISH_TIMEOUT,
             )
 
-            if not response_ok:
+            if result == "duplicate":
+                ui.notify("This artwork is already published!", type="info")
+                return
+            if result == "similar":
+                ui.notify("You've already published an artwork that looks almost the same!", type="warning")
+                return
+            if result == "timeout":
+                ui.notify("Publishing is taking too long, the artwork might still show up later", type="negative")
+                return
+            if isinstance(result, str) and result.startswith("failed: "):
+                ui.notify(f"Failed to publish: {result.removeprefix('failed: ')}", type="negative")
+                return
+            if result != "published":
                 ui.notify("Failed to publish!", type="negative")
                 return
 
@@ -2,7 +2,7 @@
 import asyncio
 import json
 import warnings
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 # Typing
 from collections.abc import Callable
@@ -63,7 +63,22 @@ SCENE.add(PICTURES)
 ROOMS: list[THREE.Group] = []  # a list of all rooms in the scene
 PAINTINGS: list[THREE.Object3D] = []  # a list of all the paintings in the scene
 LOADED_ROOMS: list[THREE.Group] = []  # a list of all the rooms that are currently loaded
-IMAGES_LIST: list[str] = []  # a list of the names of the paintings that have to be loaded in order
+ARTWORKS_URL = "https://cj12.matiiss.com/api/artworks"
+ARTWORKS_PAGE_SIZE = 1000  # the most the backend returns at once
+SLOT_CACHE_SIZE = 1024  # how many slot -> image name entries are kept around
+SLOT_CACHE: OrderedDict[int, tuple[str, list[int]]] = OrderedDict()  # names and variant sizes of the paintings of
+# recently needed slots, oldest first
+VARIANT_SIZES_BY_DISTANCE = [None, 512, 128]  # the variant shown that many rooms away (or further, for the last one),
+# None being the full image
+LOADED_VARIANTS: dict[int, int | None] = {}  # the variant shown (or being loaded) in each slot
+ARTWORKS_TOTAL: int = 0  # number of published paintings, slots past it don't have a painting yet
+ARTWORKS_CURSOR: int = 0  # id of the newest known painting, newer ones are streamed after it
+MANIFEST_URL = "./manifest/manifest.json"  # static listing published with the gallery, see backend/server/manifest.py
+MANIFEST: dict | None = None  # the loaded manifest, slots before its total are read from its shards
+ROOMS_RELOAD_PENDING: bool = False  # to reload the rooms only once for a burst of new paintings
+ROOMS_RETRY_DELAY = 5  # seconds to wait before fetching the slots of the rooms again, after it failed
+ROOMS_RETRY_PENDING: bool = False  # to retry only once for the fetches failing while waiting
+TEST_LISTING: list[tuple[str, list[int]]] = []  # the whole test listing when USE_LOCALHOST is set
 LOADED_SLOTS: list[int] = []  # a list of all slots that have been loaded
 
 # Related to Moving
@@ -386,21 +401,51 @@ def room_objects_handling(room: THREE.Group) -> None:
     room.add(pictures)
 
 
-def load_image(slot: int):
+def pick_variant(variants: list[int], distance: int) -> int | None:
+    """Pick the size of the variant to show `distance` rooms away, the smallest one at least as big as wanted"""
+    wanted = VARIANT_SIZES_BY_DISTANCE[min(distance, len(VARIANT_SIZES_BY_DISTANCE) - 1)]
+    if wanted is None:
+        return None
+    big_enough = [size for size in variants if size >= wanted]
+    # Paintings smaller than the variant don't have it, the full image is small enough then
+    return min(big_enough) if big_enough else None
+
+
+def load_image(slot: int, distance: int = 0):
     if slot >= len(PAINTINGS):
         warnings.warn(
             f"WARNING: slot to be accessed '{slot}' is greater than the maximum available "
             f"one '{len(PAINTINGS) - 1}'. The image will not be loaded."
         )
 
-    if slot >= len(IMAGES_LIST):
-        # this slot does not have a corresponding painting yet
+    cached = SLOT_CACHE.get(slot)
+    if cached is None:
+        # this slot does not have a corresponding painting yet, or it wasn't fetched
         return
+    image_loc, variants = cached
 
-    image_loc = IMAGES_LIST[slot]
+    size = pick_variant(variants, distance)
+    if slot in LOADED_VARIANTS and LOADED_VARIANTS[slot] == size:
+        # Already shown, or on its way
+        return
+    LOADED_VARIANTS[slot] = size
+    name = f"picture_{PAINTINGS[slot].parent.parent.name[5:]}_{slot:03d}"
     textureLoader = THREE.TextureLoader.new()
 
     def inner_loader(loaded_obj):
+        if LOADED_VARIANTS.get(slot) != size:
+            # The player moved on while it was loading, another variant is wanted now
+            loaded_obj.dispose()
+            return
+
+        plane = PICTURES.getObjectByName(name)
+        if plane is not None:
+            # Swap the variant of the painting already hung, freeing the old texture on the GPU
+            plane.material.map.dispose()
+            plane.material.map = loaded_obj
+            plane.material.needsUpdate = True
+            return
+
         # Put texture on a plane
         perms = convert_dict_to_js_object(
             {
@@ -422,32 +467,145 @@ def load_image(slot: int):
         plane.quaternion.copy(q)
 
         # Add the plane to the scene
-        plane.name = f"picture_{PAINTINGS[slot].parent.parent.name[5:]}_{slot:03d}"
+        plane.name = name
         PICTURES.add(plane)
         LOADED_SLOTS.append(slot)
 
+    def inner_error(_):
+        # Tried again the next time the room is loaded
+        if LOADED_VARIANTS.get(slot) == size:
+            del LOADED_VARIANTS[slot]
+
     try:
         textureLoader.load(
-            REPO_URL + image_loc,
+            REPO_URL + (f"variants/{size}/{image_loc}" if size is not None else image_loc),
             create_proxy(inner_loader),
             None,
-            create_proxy(lambda _: None),
+            create_proxy(inner_error),
         )
     except Exception as e:
         console.error(e)
 
 
-async def load_images_from_listing() -> int:
+def parse_artwork(row: list) -> tuple[str, list[int]]:
+    """Get the name and variant sizes of a painting in a listing, listings from before variants only have the name"""
+    return row[1], row[2] if len(row) > 2 else []
+
+
+async def fetch_artworks_page(offset: int, limit: int) -> tuple[list[tuple[str, list[int]]], int, int]:
+    """
+    Fetch the image names and variant sizes of slots `offset` up to `offset + limit`, along with the total number of
+    paintings and the id of the painting in the last slot of the range
+    """
     if USE_LOCALHOST:
-        r = await pyfetch("./assets/test-image-listing.json")
-    else:
-        r = await pyfetch("https://cj12.matiiss.com/api/artworks")
-    data = await r.text()
-    n_existing_images = len(IMAGES_LIST)
-    for username, img in json.loads(data)["artworks"][n_existing_images:]:
-        IMAGES_LIST.append(img)
+        if not TEST_LISTING:
+            r = await pyfetch("./assets/test-image-listing.json")
+            data = await r.text()
+            TEST_LISTING.extend(parse_artwork(row) for row in json.loads(data)["artworks"])
+        return TEST_LISTING[offset : offset + limit], len(TEST_LISTING), min(offset + limit, len(TEST_LISTING))
+
+    if MANIFEST is not None and offset < MANIFEST["total"]:
+        # Only the part of the range in the shard holding `offset`, the caller asks again for the rest
+        shard, start = divmod(offset, MANIFEST["shard_size"])
+        r = await pyfetch(f"./manifest/{MANIFEST['shards'][shard]}")
+        data = json.loads(await r.text())
+        images = [parse_artwork(row) for row in data["artworks"][start : start + limit]]
+        return images, ARTWORKS_TOTAL, ARTWORKS_CURSOR
+
+    r = await pyfetch(f"{ARTWORKS_URL}?offset={offset}&limit={limit}")
+    data = json.loads(await r.text())
+    return [parse_artwork(row) for row in data["artworks"]], data["total"], data["cursor"]
+
+
+def cache_slot(slot: int, img: str, variants: list[int]) -> None:
+    SLOT_CACHE[slot] = img, variants
+    SLOT_CACHE.move_to_end(slot)
+    while len(SLOT_CACHE) > SLOT_CACHE_SIZE:
+        SLOT_CACHE.popitem(last=False)
+
+
+async def fetch_slots(slots: list[int]) -> None:
+    """Make sure the image names of the given slots are cached, fetching the missing ones in contiguous ranges."""
+    global ARTWORKS_TOTAL
+
+    missing = []
+    for slot in sorted(set(slots)):
+        if slot in SLOT_CACHE:
+            SLOT_CACHE.move_to_end(slot)
+        elif slot < ARTWORKS_TOTAL:
+            missing.append(slot)
+
+    ranges: list[list[int]] = []
+    for slot in missing:
+        if ranges and slot == ranges[-1][1] and slot - ranges[-1][0] < ARTWORKS_PAGE_SIZE:
+            ranges[-1][1] = slot + 1
+        else:
+            ranges.append([slot, slot + 1])
+
+    for start, end in ranges:
+        while start < end:
+            images, ARTWORKS_TOTAL, _ = await fetch_artworks_page(start, end - start)
+            if not images:
+                break
+            for i, (img, variants) in enumerate(images):
+                cache_slot(start + i, img, variants)
+            start += len(images)
 
-    n_added_images = len(IMAGES_LIST) - n_existing_images
+
+async def load_manifest() -> bool:
+    """Load the static manifest, after which only paintings published after it are asked from the backend."""
+    global MANIFEST, ARTWORKS_TOTAL, ARTWORKS_CURSOR
+
+    if USE_LOCALHOST:
+        return False
+
+    try:
+        r = await pyfetch(MANIFEST_URL)
+        if not r.ok:
+            return False
+        MANIFEST = json.loads(await r.text())
+    except Exception as e:
+        console.error(e)
+        return False
+
+    ARTWORKS_TOTAL = MANIFEST["total"]
+    ARTWORKS_CURSOR = MANIFEST["high_water"]
+    return True
+
+
+async def load_images_since_cursor() -> int:
+    """Fetch the names of the paintings published after `ARTWORKS_CURSOR`, they take the slots after the known ones."""
+    global ARTWORKS_TOTAL, ARTWORKS_CURSOR
+
+    n_existing_images = ARTWORKS_TOTAL
+    has_more = True
+    while has_more:
+        r = await pyfetch(f"{ARTWORKS_URL}?since_id={ARTWORKS_CURSOR}&limit={ARTWORKS_PAGE_SIZE}")
+        data = json.loads(await r.text())
+        for row in data["artworks"]:
+            cache_slot(ARTWORKS_TOTAL, *parse_artwork(row))
+            ARTWORKS_TOTAL += 1
+        ARTWORKS_CURSOR = data["cursor"]
+        has_more = data["has_more"]
+
+    return ARTWORKS_TOTAL - n_existing_images
+
+
+async def load_images_from_listing() -> int:
+    """Fetch the number of published paintings, along with the names of the newly published ones."""
+    global ARTWORKS_TOTAL, ARTWORKS_CURSOR
+
+    n_existing_images = ARTWORKS_TOTAL
+    # Slots are in publishing order, so new paintings are always past the last known slot
+    images, ARTWORKS_TOTAL, cursor = await fetch_artworks_page(n_existing_images, ARTWORKS_PAGE_SIZE)
+    for i, (img, variants) in enumerate(images):
+        cache_slot(n_existing_images + i, img, variants)
+    if n_existing_images + len(images) < ARTWORKS_TOTAL:
+        # Only the id of the newest painting is needed, not the names of the ones in between
+        _, ARTWORKS_TOTAL, cursor = await fetch_artworks_page(ARTWORKS_TOTAL, 1)
+    ARTWORKS_CURSOR = cursor
+
+    n_added_images = ARTWORKS_TOTAL - n_existing_images
 
     return n_added_images
 
@@ -490,24 +648,19 @@ async def clone_rooms(chunks: list[tuple[int, int]], layout: MAP, apothem: float
 # -------------------------------------- LAZY LOADING --------------------------------------
 
 
-async def load_room(room: THREE.Group) -> None:
-    """Loads a room and/or makes it visible."""
-    paintings = room.getObjectByName("Pictures")
+def get_room_slots(room: THREE.Group) -> list[int]:
+    return [int(p.name.split("_")[1]) for p in room.getObjectByName("Pictures").children if p.name.startswith("pic_")]
 
-    if any(p.name.startswith(f"picture_{room.name[5:]}") for p in PICTURES.children):
-        # Checks whther the room has any "photoframes" in it, if yes then it has been previously loaded and we just
-        # need to set it to be visible
 
-        for p in PICTURES.children:
-            if p.name.startswith(f"picture_{room.name[5:]}"):
-                p.visible = True
-    else:
-        # This is the first time we are loading this room so we need to load its paintings too
-        for p in paintings.children:
-            if p.name.startswith("pic_"):
-                slot = int(p.name.split("_")[1])
-                if slot < len(IMAGES_LIST):
-                    load_image(slot)
+async def load_room(room: THREE.Group, distance: int = 0) -> None:
+    """Loads a room and/or makes it visible, showing the variants of its paintings for `distance` rooms away."""
+    for p in PICTURES.children:
+        if p.name.startswith(f"picture_{room.name[5:]}"):
+            p.visible = True
+
+    # Paintings not loaded yet are loaded, the others only if they should be shown in another variant now
+    for slot in get_room_slots(room):
+        load_image(slot, distance)
 
 
 async def unload_room(room: THREE.Group) -> None:
@@ -527,29 +680,45 @@ async def updated_loaded_rooms(
     def get_chunk_coords(room):
         return tuple(int(i) for i in room.name.split("_")[1:])
 
-    def calc(room):
-        return (
-            sum(
-                abs(i - j)
-                for i, j in zip(
-                    get_chunk_coords(current_room),
-                    get_chunk_coords(room),
-                    strict=True,
-                )
+    def distance(room):
+        return sum(
+            abs(i - j)
+            for i, j in zip(
+                get_chunk_coords(current_room),
+                get_chunk_coords(room),
+                strict=True,
             )
-            <= r
         )
 
+    def calc(room):
+        return distance(room) <= r
+
+    # Only the slots of the rooms about to be loaded are fetched
+    try:
+        await fetch_slots(
+            [
+                slot
+                for room in ROOMS
+                if calc(room) and (force_reload or room not in LOADED_ROOMS)
+                for slot in get_room_slots(room)
+            ]
+        )
+    except Exception as e:
+        # The rooms are still loaded with the slots that are cached, the retry fills in the rest
+        console.error(e)
+        asyncio.ensure_future(retry_loading_rooms())
+
     for room in ROOMS:
         if room in LOADED_ROOMS:
             if not calc(room):
                 await unload_room(room)
                 LOADED_ROOMS.remove(room)
-            elif force_reload:
-                await load_room(room)
+            else:
+                # Swaps in bigger variants as the player approaches, and smaller ones as they walk away
+                await load_room(room, distance(room))
         else:
             if calc(room):
-                await load_room(room)
+                await load_room(room, distance(room))
                 LOADED_ROOMS.append(room)
 
 
@@ -658,24 +827,62 @@ async def load_gallery() -> None:
     await clone_rooms(layout_points, layout, apothem)
 
 
-async def image_query_loop():
-    apothem = get_room_apothem()
-    while True:
-        await asyncio.sleep(15)
-
-        # Might error out because of downtime, no big deal
-        try:
-            n_added_images = await load_images_from_listing()
-            if n_added_images:
-                chunk_x, chunk_z = get_player_chunk(apothem)
-                print(f"New images to be added: {n_added_images}")
-                await updated_loaded_rooms(
-                    SCENE.getObjectByName(f"room_{chunk_x}_{chunk_z}"),
-                    force_reload=True,
-                    r=3,  # A slightly bigger radius, just in case
-                )
-        except Exception:
-            ...
+async def reload_rooms_soon() -> None:
+    global ROOMS_RELOAD_PENDING
+
+    if ROOMS_RELOAD_PENDING:
+        return
+    ROOMS_RELOAD_PENDING = True
+
+    # Paintings published at the same time arrive in a burst, wait for the rest of it
+    await asyncio.sleep(0.5)
+    ROOMS_RELOAD_PENDING = False
+
+    chunk_x, chunk_z = get_player_chunk(get_room_apothem())
+    await updated_loaded_rooms(
+        SCENE.getObjectByName(f"room_{chunk_x}_{chunk_z}"),
+        force_reload=True,
+        r=3,  # A slightly bigger radius, just in case
+    )
+
+
+async def retry_loading_rooms() -> None:
+    global ROOMS_RETRY_PENDING
+
+    if ROOMS_RETRY_PENDING:
+        return
+    ROOMS_RETRY_PENDING = True
+
+    await asyncio.sleep(ROOMS_RETRY_DELAY)
+    ROOMS_RETRY_PENDING = False
+
+    # Forced, the rooms whose slots failed to be fetched count as loaded already
+    await reload_rooms_soon()
+
+
+def on_artwork_published(event) -> None:
+    global ARTWORKS_TOTAL, ARTWORKS_CURSOR
+
+    artwork_id = int(event.lastEventId)
+    if artwork_id <= ARTWORKS_CURSOR:
+        # Already known, e.g. replayed after reconnecting. Ids are in commit order, a lower one is never new
+        return
+    ARTWORKS_CURSOR = artwork_id
+
+    data = json.loads(event.data)
+    cache_slot(ARTWORKS_TOTAL, data["filename"], data.get("variants", []))
+    ARTWORKS_TOTAL += 1
+    print(f"New image to be added: {ARTWORKS_TOTAL - 1}")
+    asyncio.ensure_future(reload_rooms_soon())
+
+
+def subscribe_to_artworks() -> None:
+    """Get newly published paintings pushed by the backend, the browser reconnects on its own with the last event id"""
+    if USE_LOCALHOST:
+        return
+
+    source = window.EventSource.new(f"{ARTWORKS_URL}/stream?since_id={ARTWORKS_CURSOR}")
+    source.addEventListener("artwork", create_proxy(on_artwork_published))
 
 
 def tp_to_slot(slot: int) -> None:
@@ -694,7 +901,19 @@ def tp_to_slot(slot: int) -> None:
     CAMERA.position.set(chunk_x * apothem * 2, CAMERA.position.y, chunk_z * apothem * 2)
 
 
-def url_process() -> None:
+async def find_slot(picture: str) -> int | None:
+    if USE_LOCALHOST:
+        await fetch_artworks_page(0, 0)
+        names = [img for img, _ in TEST_LISTING]
+        return names.index(picture) if picture in names else None
+
+    r = await pyfetch(f"{ARTWORKS_URL}/{window.encodeURIComponent(picture)}")
+    if r.status == 404:
+        return None
+    return json.loads(await r.text())["slot"]
+
+
+async def url_process() -> None:
     params = window.URLSearchParams.new(window.location.search)
 
     idx_raw = params.get("idx")
@@ -702,12 +921,11 @@ def url_process() -> None:
     if idx_raw is not None:
         idx = int(idx_raw)
     elif picture is not None:
-        try:
-            idx = IMAGES_LIST.index(picture)
-            print(f"Image with name {picture} found")
-        except ValueError:
+        idx = await find_slot(picture)
+        if idx is None:
             print(f"Image with name {picture} not found")
             return
+        print(f"Image with name {picture} found")
     else:
         return
 
@@ -715,17 +933,20 @@ def url_process() -> None:
 
 
 async def main():
-    await load_images_from_listing()
+    if await load_manifest():
+        await load_images_since_cursor()
+    else:
+        await load_images_from_listing()
 
     while not SCENE.getObjectByName("room_0_0"):
         await asyncio.sleep(0.05)
 
     asyncio.ensure_future(updated_loaded_rooms(SCENE.getObjectByName("room_0_0")))
 
-    asyncio.ensure_future(image_query_loop())
+    subscribe_to_artworks()
 
     # TP camera
-    url_process()
+    await url_process()
 
     clock = THREE.Clock.new()
     while True: